@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Benchmark the PyTorch fallback kernels against the native vLLM CPU ops
+
+Builds synthetic paged KV caches in the layouts the patches assume:
+    key_cache:   [num_blocks, num_kv_heads, head_size // x, block_size, x] (5D)
+    value_cache: [num_blocks, num_kv_heads, head_size, block_size] (4D)
+and compares the code injected by patch_cpu_attn.py / patch_paged_attention.py with
+ops.reshape_and_cache / ops.paged_attention_v1 (when vLLM is installed).
+
+Usage:
+    python3 benchmark_kernels.py --output bench.json
+    python3 benchmark_kernels.py --batch-sizes 1,16 --context-lens 512,2048 --gqa-ratios 1,6
+    python3 benchmark_kernels.py --quick
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+import patch_cpu_attn
+import patch_paged_attention
+
+DTYPES = {
+    'float32': torch.float32,
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+}
+
+# Quantization scale (k_scale / v_scale) used for each kv_cache_dtype
+KV_CACHE_SCALES = {
+    'auto': 1.0,
+    'fp8': 0.5,
+    'fp8_e4m3': 0.5,
+    'fp8_e5m2': 0.5,
+    'int8': 0.05,
+}
+
+# Element type of each quantized kv_cache_dtype, for the reference (de)quantization
+KV_CACHE_ELEMENT_DTYPES = {
+    'fp8': torch.float8_e4m3fn,
+    'fp8_e4m3': torch.float8_e4m3fn,
+    'fp8_e5m2': torch.float8_e5m2,
+    'int8': torch.int8,
+}
+
+# Max abs error accepted when comparing against the reference, per model dtype
+TOLERANCES = {
+    torch.float32: 1e-4,
+    torch.bfloat16: 2e-2,
+    torch.float16: 2e-3,
+}
+
+def load_native_ops():
+    """Import vLLM's _custom_ops, None if vLLM is not installed"""
+    try:
+        from vllm import _custom_ops as ops
+    except Exception as e:
+        print(f'Native vLLM ops not available, benchmarking fallbacks only: {e}')
+        return None
+    return ops
+
+def load_fallback_kernels(ops):
+    """Build a _PagedAttention class from the exact source the patches inject into cpu_attn.py"""
+    source = (
+        'class _PagedAttention:\n'
+        + patch_cpu_attn.NEW_WRITE_TO_PAGED_CACHE + '\n\n'
+        + patch_paged_attention.NEW_FORWARD_DECODE + '\n'
+    )
+    namespace = {'torch': torch, 'ops': ops}
+    exec(compile(source, '<patched cpu_attn.py>', 'exec'), namespace)
+    return namespace['_PagedAttention']
+
+def cache_element_dtype(dtype, kv_cache_dtype):
+    """Tensor dtype of the KV cache: the model dtype, or int8/uint8 bytes for quantized caches"""
+    if kv_cache_dtype == 'auto':
+        return dtype
+    return torch.int8 if kv_cache_dtype == 'int8' else torch.uint8
+
+def reference_quantize(x, scale, kv_cache_dtype, cache_dtype):
+    """x / scale in the cache element type, written independently of the fallback kernels"""
+    if kv_cache_dtype == 'auto':
+        return x
+    element_dtype = KV_CACHE_ELEMENT_DTYPES[kv_cache_dtype]
+    scaled = x.float() / scale
+    if element_dtype == torch.int8:
+        # Round to nearest like the native int8 cache write, .to() alone would truncate
+        scaled = scaled.round()
+    return scaled.to(element_dtype).view(cache_dtype)
+
+def reference_dequantize(x, scale, kv_cache_dtype):
+    """Cache entries as float32 (x * scale)"""
+    if kv_cache_dtype == 'auto':
+        return x.float()
+    return x.view(KV_CACHE_ELEMENT_DTYPES[kv_cache_dtype]).float() * scale
+
+def make_case(batch_size, context_len, block_size, head_size, num_kv_heads, gqa_ratio,
+              dtype, kv_cache_dtype='auto', seed=0):
+    """Create query, paged KV cache and block tables for one benchmark configuration"""
+    generator = torch.Generator().manual_seed(seed)
+    num_heads = num_kv_heads * gqa_ratio
+    cache_dtype = cache_element_dtype(dtype, kv_cache_dtype)
+    x = 16 // torch.tensor([], dtype=cache_dtype).element_size()
+    blocks_per_seq = (context_len + block_size - 1) // block_size
+    num_blocks = batch_size * blocks_per_seq + 1
+    k_scale = torch.tensor(KV_CACHE_SCALES[kv_cache_dtype], dtype=torch.float32)
+    v_scale = torch.tensor(KV_CACHE_SCALES[kv_cache_dtype], dtype=torch.float32)
+
+    key_cache = reference_quantize(torch.randn(
+        num_blocks, num_kv_heads, head_size // x, block_size, x, generator=generator).to(dtype),
+        k_scale, kv_cache_dtype, cache_dtype)
+    value_cache = reference_quantize(torch.randn(
+        num_blocks, num_kv_heads, head_size, block_size, generator=generator).to(dtype),
+        v_scale, kv_cache_dtype, cache_dtype)
+    # Shuffle physical blocks so sequences are scattered like a real paged cache
+    block_tables = torch.randperm(num_blocks, generator=generator)[:batch_size * blocks_per_seq]
+    block_tables = block_tables.view(batch_size, blocks_per_seq).to(torch.int32)
+    context_lens = torch.full((batch_size,), context_len, dtype=torch.int32)
+    query = torch.randn(batch_size, num_heads, head_size, generator=generator).to(dtype)
+
+    # Prefill write of every context token: slot = block_id * block_size + offset
+    positions = torch.arange(context_len)
+    slot_mapping = (block_tables[:, positions // block_size].long() * block_size
+                    + positions % block_size).flatten()
+    num_tokens = slot_mapping.shape[0]
+    key = torch.randn(num_tokens, num_kv_heads, head_size, generator=generator).to(dtype)
+    value = torch.randn(num_tokens, num_kv_heads, head_size, generator=generator).to(dtype)
+
+    return {
+        'query': query,
+        'key': key,
+        'value': value,
+        # What a correct cache write stores (quantized bytes for fp8/int8 caches)
+        'key_stored': reference_quantize(key, k_scale, kv_cache_dtype, cache_dtype),
+        'value_stored': reference_quantize(value, v_scale, kv_cache_dtype, cache_dtype),
+        'key_cache': key_cache,
+        'value_cache': value_cache,
+        'block_tables': block_tables,
+        'context_lens': context_lens,
+        'slot_mapping': slot_mapping,
+        'max_context_len': context_len,
+        'block_size': block_size,
+        'num_kv_heads': num_kv_heads,
+        'scale': 1.0 / math.sqrt(head_size),
+        'kv_cache_dtype': kv_cache_dtype,
+        'k_scale': k_scale,
+        'v_scale': v_scale,
+    }
+
+def reference_decode(case):
+    """Dense per-sequence attention in float32, used as ground truth for the decode kernels"""
+    query = case['query']
+    key_cache = reference_dequantize(case['key_cache'], case['k_scale'], case['kv_cache_dtype'])
+    value_cache = reference_dequantize(case['value_cache'], case['v_scale'], case['kv_cache_dtype'])
+    block_size = case['block_size']
+    num_kv_heads = case['num_kv_heads']
+    batch_size, num_heads, head_size = query.shape
+    num_q_per_kv = num_heads // num_kv_heads
+    output = torch.zeros(batch_size, num_heads, head_size, dtype=torch.float32)
+    for seq_idx in range(batch_size):
+        seq_len = int(case['context_lens'][seq_idx])
+        num_blocks = (seq_len + block_size - 1) // block_size
+        block_ids = case['block_tables'][seq_idx, :num_blocks].long()
+        # [num_blocks, num_kv_heads, head_size // x, block_size, x] -> [num_kv_heads, seq_len, head_size]
+        keys = key_cache[block_ids].permute(1, 0, 3, 2, 4).reshape(
+            num_kv_heads, num_blocks * block_size, head_size)[:, :seq_len]
+        # [num_blocks, num_kv_heads, head_size, block_size] -> [num_kv_heads, seq_len, head_size]
+        values = value_cache[block_ids].permute(1, 0, 3, 2).reshape(
+            num_kv_heads, num_blocks * block_size, head_size)[:, :seq_len]
+        for head_idx in range(num_heads):
+            kv_head = head_idx // num_q_per_kv
+            scores = keys[kv_head] @ query[seq_idx, head_idx].float() * case['scale']
+            output[seq_idx, head_idx] = torch.softmax(scores, dim=-1) @ values[kv_head]
+    return output
+
+def check_cache_write(case, key_cache, value_cache):
+    """Read every written token back in token-major order and return the max abs error"""
+    num_kv_heads = case['num_kv_heads']
+    head_size = case['key'].shape[2]
+    slots = case['slot_mapping']
+    # [num_blocks, num_kv_heads, head_size // x, block_size, x] -> [num_slots, num_kv_heads, head_size]
+    keys = key_cache.permute(0, 3, 1, 2, 4).reshape(-1, num_kv_heads, head_size)[slots]
+    # [num_blocks, num_kv_heads, head_size, block_size] -> [num_slots, num_kv_heads, head_size]
+    values = value_cache.permute(0, 3, 1, 2).reshape(-1, num_kv_heads, head_size)[slots]
+    return max(
+        (keys.float() - case['key_stored'].float()).abs().max().item(),
+        (values.float() - case['value_stored'].float()).abs().max().item(),
+    )
+
+def decode_impls(ops, kernels):
+    """Decode implementations: name -> fn(case, output)"""
+    def fallback(fn):
+        def run(case, output):
+            fn(output, case['query'], case['key_cache'], case['value_cache'],
+               case['block_tables'], case['context_lens'], case['max_context_len'],
+               case['kv_cache_dtype'], case['num_kv_heads'], case['scale'], None,
+               case['k_scale'], case['v_scale'], case['block_size'])
+        return run
+
+    impls = {
+        'fallback_batched': fallback(kernels._paged_attention_v1_fallback),
+        'fallback_streaming': fallback(kernels._paged_attention_v1_streaming_fallback),
+    }
+    if ops is not None:
+        def native(case, output):
+            # Same arguments as _PagedAttention.forward_decode
+            ops.paged_attention_v1(
+                output, case['query'], case['key_cache'], case['value_cache'],
+                case['num_kv_heads'], case['scale'], case['block_tables'], case['context_lens'],
+                case['block_size'], case['max_context_len'], None, case['kv_cache_dtype'],
+                case['k_scale'], case['v_scale'], 0, 0, 0, 64, 0)
+        impls['native'] = native
+    return impls
+
+def cache_write_impls(ops, kernels):
+    """Cache write implementations: name -> fn(case, key_cache, value_cache)"""
+    def fallback(case, key_cache, value_cache):
+        kernels._reshape_and_cache_fallback(
+            case['key'], case['value'], key_cache, value_cache,
+            case['slot_mapping'], case['kv_cache_dtype'], case['k_scale'], case['v_scale'])
+
+    impls = {'fallback': fallback}
+    # reshape_and_cache_backend is None when _custom_ops found no native kernel
+    if ops is not None and getattr(ops, 'reshape_and_cache_backend', '') is not None:
+        def native(case, key_cache, value_cache):
+            ops.reshape_and_cache(
+                case['key'], case['value'], key_cache, value_cache,
+                case['slot_mapping'], case['kv_cache_dtype'], case['k_scale'], case['v_scale'])
+        impls['native'] = native
+    return impls
+
+def time_fn(fn, warmup, iters):
+    """Return per-call latencies in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    return latencies
+
+def peak_memory_mb(fn):
+    """Peak CPU tensor memory allocated during one call, from the profiler's memory events"""
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    fd, trace_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        prof.export_chrome_trace(trace_path)
+        with open(trace_path, 'r') as f:
+            events = json.load(f).get('traceEvents', [])
+    finally:
+        os.remove(trace_path)
+    memory_events = sorted(
+        (e for e in events if e.get('name') == '[memory]' and 'Total Allocated' in e.get('args', {})),
+        key=lambda e: e['ts'])
+    if not memory_events:
+        return None
+    first = memory_events[0]['args']
+    baseline = first['Total Allocated'] - first['Bytes']
+    peak = max(e['args']['Total Allocated'] for e in memory_events)
+    return max(peak - baseline, 0) / (1024 * 1024)
+
+def summarize(latencies, tokens_per_call):
+    """Latency percentiles and throughput for one implementation"""
+    median = statistics.median(latencies)
+    p90 = sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+    return {
+        'latency_ms_median': round(median, 4),
+        'latency_ms_p90': round(p90, 4),
+        'tokens_per_s': round(tokens_per_call / (median / 1000.0), 2) if median > 0 else None,
+    }
+
+def run_case(config, dtype, ops, kernels, args):
+    """Benchmark every implementation of both ops for one configuration"""
+    case = make_case(dtype=dtype, kv_cache_dtype=args.kv_cache_dtype, seed=args.seed, **config)
+    tolerance = TOLERANCES[dtype]
+    results = []
+    base = dict(config, num_heads=config['num_kv_heads'] * config['gqa_ratio'],
+                dtype=str(dtype).replace('torch.', ''), kv_cache_dtype=args.kv_cache_dtype)
+
+    # Decode: one new token per sequence per call
+    expected = reference_decode(case)
+    for name, impl in decode_impls(ops, kernels).items():
+        result = dict(base, op='paged_attention_v1', impl=name)
+        output = torch.empty_like(case['query'])
+        fn = lambda: impl(case, output)
+        try:
+            fn()
+            max_abs_err = (output.float() - expected).abs().max().item()
+            result.update(summarize(time_fn(fn, args.warmup, args.iters), config['batch_size']))
+            result['peak_memory_mb'] = peak_memory_mb(fn)
+            result['max_abs_err'] = max_abs_err
+            result['equivalent'] = max_abs_err <= tolerance
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        results.append(result)
+
+    # Cache write: prefill of every context token of every sequence
+    num_tokens = case['slot_mapping'].shape[0]
+    written = {}
+    for name, impl in cache_write_impls(ops, kernels).items():
+        result = dict(base, op='reshape_and_cache', impl=name)
+        key_cache = torch.zeros_like(case['key_cache'])
+        value_cache = torch.zeros_like(case['value_cache'])
+        fn = lambda: impl(case, key_cache, value_cache)
+        try:
+            fn()
+            max_abs_err = check_cache_write(case, key_cache, value_cache)
+            written[name] = (key_cache.clone(), value_cache.clone())
+            result.update(summarize(time_fn(fn, args.warmup, args.iters), num_tokens))
+            result['peak_memory_mb'] = peak_memory_mb(fn)
+            result['max_abs_err'] = max_abs_err
+            result['equivalent'] = max_abs_err == 0.0
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        results.append(result)
+
+    # The fallback must leave the caches bit-identical to the native kernel
+    if 'native' in written and 'fallback' in written:
+        identical = all(torch.equal(a, b) for a, b in zip(written['native'], written['fallback']))
+        for result in results:
+            if result['op'] == 'reshape_and_cache' and result['impl'] == 'fallback':
+                result['equivalent'] = result['equivalent'] and identical
+
+    return results
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+def print_result(result):
+    config = (f"{result['op']:<19} {result['impl']:<19} "
+              f"bs={result['batch_size']:<3} ctx={result['context_len']:<5} "
+              f"blk={result['block_size']:<3} hd={result['head_size']:<4} "
+              f"gqa={result['gqa_ratio']:<2}")
+    if 'error' in result:
+        print(f"{config} ERROR {result['error']}")
+        return
+    peak = result['peak_memory_mb']
+    peak_str = f'{peak:9.2f}MB' if peak is not None else '      n/a'
+    print(f"{config} {result['latency_ms_median']:10.3f}ms {result['tokens_per_s']:14.1f} tok/s "
+          f"{peak_str} err={result['max_abs_err']:.2e} "
+          f"{'OK' if result['equivalent'] else 'MISMATCH'}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fallback vs native vLLM CPU kernels')
+    parser.add_argument('--batch-sizes', type=parse_int_list, default=[1, 4, 16])
+    parser.add_argument('--context-lens', type=parse_int_list, default=[128, 512, 2048])
+    parser.add_argument('--block-sizes', type=parse_int_list, default=[16])
+    parser.add_argument('--head-sizes', type=parse_int_list, default=[64, 128])
+    parser.add_argument('--gqa-ratios', type=parse_int_list, default=[1, 6],
+                        help='num_heads / num_kv_heads (Qwen2.5-1.5B uses 6)')
+    parser.add_argument('--num-kv-heads', type=int, default=2)
+    parser.add_argument('--dtype', choices=sorted(DTYPES), default='bfloat16')
+    parser.add_argument('--kv-cache-dtype', choices=sorted(KV_CACHE_SCALES), default='auto')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='Small sweep for a smoke test')
+    parser.add_argument('--output', default=None, help='Write results as JSON to this path')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.batch_sizes, args.context_lens, args.head_sizes = [1, 4], [128], [64]
+        args.warmup, args.iters = 1, 3
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    dtype = DTYPES[args.dtype]
+
+    ops = load_native_ops()
+    kernels = load_fallback_kernels(ops)
+
+    results = []
+    sweep = itertools.product(
+        args.batch_sizes, args.context_lens, args.block_sizes, args.head_sizes, args.gqa_ratios)
+    for batch_size, context_len, block_size, head_size, gqa_ratio in sweep:
+        x = 16 // torch.tensor([], dtype=cache_element_dtype(dtype, args.kv_cache_dtype)).element_size()
+        if head_size % x != 0:
+            print(f'Skipping head_size={head_size}: not a multiple of x={x}')
+            continue
+        config = {
+            'batch_size': batch_size,
+            'context_len': context_len,
+            'block_size': block_size,
+            'head_size': head_size,
+            'num_kv_heads': args.num_kv_heads,
+            'gqa_ratio': gqa_ratio,
+        }
+        for result in run_case(config, dtype, ops, kernels, args):
+            print_result(result)
+            results.append(result)
+
+    mismatches = [r for r in results if 'error' not in r and not r['equivalent']]
+    if mismatches:
+        print(f'Warning: {len(mismatches)} results are not numerically equivalent to the reference')
+
+    if args.output:
+        try:
+            import vllm
+            vllm_version = getattr(vllm, '__version__', None)
+        except Exception:
+            vllm_version = None
+        report = {
+            'meta': {
+                'torch_version': torch.__version__,
+                'vllm_version': vllm_version,
+                'native_available': ops is not None,
+                'python_version': platform.python_version(),
+                'machine': platform.machine(),
+                'processor': platform.processor(),
+                'num_threads': torch.get_num_threads(),
+                'dtype': args.dtype,
+                'kv_cache_dtype': args.kv_cache_dtype,
+                'warmup': args.warmup,
+                'iters': args.iters,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f'Results written to {args.output}')
+
+    return 0 if not mismatches else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,36 @@
 """
 FastAPI Chat Server - Using LangChain Agent + vLLM
 """
+import ast
 import asyncio
+import decimal
+import hashlib
+import json
 import logging
+import math
 import os
 import re
+import time
+import unicodedata
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from typing import List, Optional, Any
+from typing import List, Optional, Any, Union
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+import httpx
 # LangChain imports - using langchain_classic (based on source code)
-from langchain_classic.agents import AgentExecutor, create_react_agent
+from langchain_classic.agents import AgentExecutor, create_react_agent, create_tool_calling_agent
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.tools import StructuredTool
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from pydantic import BaseModel
 
+from expression_engine import MODES as EXPRESSION_MODES, ExpressionEngine
+from prompt_compiler import compile_prompt, count_tokens, tool_description
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -39,6 +53,7 @@ async def lifespan(app: FastAPI):
     
     # Cleanup resources on shutdown
     logger.info("Chat server is shutting down...")
+    await close_http_clients()
 
 app = FastAPI(title="vLLM + LangChain Chat Server", lifespan=lifespan)
 
@@ -59,13 +74,424 @@ tools: List[Any] = []
 vllm_server_url = os.getenv("VLLM_SERVER_URL", "http://vllm-server:8001/v1")
 vllm_model_name = os.getenv("VLLM_MODEL_NAME", "Qwen/Qwen2.5-1.5B-Instruct")
 
+# Agent mode: react (tool calls parsed from the model's text) or tools (native OpenAI tool
+# calling, needs --enable-auto-tool-choice and a --tool-call-parser on the vLLM server)
+agent_mode = os.getenv("CHAT_AGENT_MODE", "react").lower()
+
+# Math tools end the agent run with their result (formatted by the server like the fast path)
+# instead of sending it back to vLLM for one more generation of "The answer is ..."
+tool_return_direct = os.getenv("CHAT_TOOL_RETURN_DIRECT", "1").lower() in ("1", "true", "yes")
+
+# ReAct steps stop at the first hallucinated observation or follow-up question instead of
+# running on to max_tokens
+react_stop_sequences = ["\nObservation", "\nQuestion:"]
+# Guided decoding of ReAct steps against the Thought/Action/Final Answer format, with the
+# action restricted to the tool names: off, structured_outputs (vLLM >= 0.10.2) or
+# guided_regex (older vLLM)
+guided_decoding = os.getenv("CHAT_GUIDED_DECODING", "off").lower()
+
+# Arithmetic engine behind calculate_expression (restricted AST, LRU cache of compiled
+# expressions): float or decimal (exact decimal arithmetic, results stay Decimal) mode
+expression_mode = os.getenv("CHAT_EXPRESSION_MODE", "float").lower()
+expression_engine = ExpressionEngine(cache_size=int(os.getenv("CHAT_EXPRESSION_CACHE_SIZE", "1024")))
+
+# Response cache configuration (max entries 0 disables the cache, max bytes 0 means no byte limit)
+cache_ttl = float(os.getenv("CHAT_CACHE_TTL", "300"))
+cache_max_entries = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1024"))
+cache_max_bytes = int(os.getenv("CHAT_CACHE_MAX_BYTES", "0"))
+
+# Max concurrent agent runs, sized to vLLM's batch capacity (--max-num-seqs in start_vllm_server.sh)
+agent_concurrency = int(os.getenv("CHAT_AGENT_CONCURRENCY", "16"))
+agent_semaphore = asyncio.Semaphore(agent_concurrency)
+agent_running = 0
+agent_waiting = 0
+
+# Admission control: reject early (429) when a new agent run would not finish within its
+# priority class deadline (seconds), selected by the X-Priority request header
+DEFAULT_ADMISSION_DEADLINES = {"high": 60.0, "normal": 30.0, "low": 10.0}
+
+def parse_admission_deadlines(value: str) -> dict:
+    """name=seconds pairs over the defaults, malformed entries are skipped with a warning"""
+    deadlines = dict(DEFAULT_ADMISSION_DEADLINES)
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, seconds = item.partition("=")
+        try:
+            deadline = float(seconds)
+        except ValueError:
+            deadline = None
+        if not name.strip() or deadline is None or not deadline > 0:
+            logger.warning(f"Ignoring malformed CHAT_ADMISSION_DEADLINES entry {item.strip()!r}")
+            continue
+        deadlines[name.strip().lower()] = deadline
+    return deadlines
+
+admission_deadlines = parse_admission_deadlines(os.getenv("CHAT_ADMISSION_DEADLINES", "high=60,normal=30,low=10"))
+admission_default_priority = "normal"
+
+class AdmissionController:
+    """Estimates the completion time of a new agent run from queue depth and recent latencies"""
+
+    # Latency assumed until the first runs have completed
+    DEFAULT_LATENCY = 5.0
+
+    def __init__(self, deadlines: dict, concurrency: int, window: int = 50):
+        self.deadlines = deadlines
+        self.concurrency = concurrency
+        self.latencies = deque(maxlen=window)
+        self.admitted = {name: 0 for name in deadlines}
+        self.rejected = {name: 0 for name in deadlines}
+
+    def record_latency(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def latency_estimate(self) -> float:
+        if not self.latencies:
+            return self.DEFAULT_LATENCY
+        return sum(self.latencies) / len(self.latencies)
+
+    def expected_wait(self, running: int, waiting: int) -> float:
+        """Expected queueing time before a new run gets a slot"""
+        if running + waiting < self.concurrency:
+            return 0.0
+        # Runs ahead of us drain in waves of `concurrency`
+        waves = (running + waiting - self.concurrency) // self.concurrency + 1
+        return waves * self.latency_estimate()
+
+    def admit(self, priority: str, running: int, waiting: int) -> Optional[float]:
+        """Admit a new run, or return the Retry-After seconds if it would miss its deadline"""
+        expected = self.expected_wait(running, waiting) + self.latency_estimate()
+        if expected > self.deadlines[priority]:
+            self.rejected[priority] += 1
+            return expected - self.deadlines[priority]
+        self.admitted[priority] += 1
+        return None
+
+    def stats(self, running: int, waiting: int) -> dict:
+        return {
+            "deadlines": self.deadlines,
+            "latency_estimate": round(self.latency_estimate(), 3),
+            "expected_wait": round(self.expected_wait(running, waiting), 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+admission = AdmissionController(admission_deadlines, agent_concurrency)
+
+# Max messages per /chat/batch request; batches default to low priority for admission control
+batch_max_size = int(os.getenv("CHAT_BATCH_MAX_SIZE", "256"))
+batch_default_priority = "low"
+# Agent slots one batch may hold or queue for at a time: agent slots are served in arrival
+# order, so this caps how many batch runs an interactive /chat request can queue behind
+batch_max_concurrency = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", str(max(1, agent_concurrency // 4))))
+
+# Shared HTTP connection pool to vLLM, sized to its batch capacity by default
+http_max_connections = int(os.getenv("CHAT_HTTP_MAX_CONNECTIONS", str(agent_concurrency)))
+http_keepalive_expiry = float(os.getenv("CHAT_HTTP_KEEPALIVE_EXPIRY", "60"))
+http2_enabled = os.getenv("CHAT_HTTP2", "0").lower() in ("1", "true", "yes")
+http_client: Optional[httpx.Client] = None
+http_async_client: Optional[httpx.AsyncClient] = None
+http_stats = {"requests": 0, "new_connections": 0}
+
+def _count_http_event(event_name: str):
+    # httpcore emits connect_tcp only when the pool opens a new connection
+    if event_name == "connection.connect_tcp.complete":
+        http_stats["new_connections"] += 1
+
+def _http_trace(event_name: str, info: dict):
+    _count_http_event(event_name)
+
+async def _http_trace_async(event_name: str, info: dict):
+    _count_http_event(event_name)
+
+def _http_request_hook(request: httpx.Request):
+    http_stats["requests"] += 1
+    request.extensions["trace"] = _http_trace
+
+async def _http_request_hook_async(request: httpx.Request):
+    http_stats["requests"] += 1
+    request.extensions["trace"] = _http_trace_async
+
+class _DrainOnCloseStream(httpx.AsyncByteStream):
+    """
+    Response stream that reads the remaining end of a finished response before closing.
+
+    The OpenAI SDK stops reading a streamed completion at "data: [DONE]" and closes the
+    response before the final chunk terminator arrives, which makes httpcore drop the
+    connection instead of returning it to the pool. Every ReAct step streams, so without
+    this each LLM call opens a new TCP connection.
+    """
+
+    # Only wait briefly: a stream closed mid-generation must be dropped so vLLM aborts it
+    DRAIN_TIMEOUT = 0.05
+
+    def __init__(self, stream: httpx.AsyncByteStream):
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._exhausted = False
+
+    async def __aiter__(self):
+        async for chunk in self._iterator:
+            yield chunk
+        self._exhausted = True
+
+    async def _drain(self):
+        async for chunk in self._iterator:
+            if chunk:
+                # Still generating, not just the terminator: let the connection close
+                return
+        self._exhausted = True
+
+    async def aclose(self):
+        if not self._exhausted:
+            try:
+                await asyncio.wait_for(self._drain(), self.DRAIN_TIMEOUT)
+            except Exception:
+                pass
+        await self._stream.aclose()
+
+class _DrainingAsyncTransport(httpx.AsyncBaseTransport):
+    """Async transport wrapper that keeps streamed responses' connections reusable"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self._transport.handle_async_request(request)
+        response.stream = _DrainOnCloseStream(response.stream)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def create_http_clients():
+    """Create the shared sync/async HTTP clients used by all LLM calls"""
+    global http_client, http_async_client, http2_enabled
+    if http2_enabled:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("CHAT_HTTP2 is set but the h2 package is not installed (pip install httpx[http2]), using HTTP/1.1")
+            http2_enabled = False
+    limits = httpx.Limits(
+        max_connections=http_max_connections,
+        max_keepalive_connections=http_max_connections,
+        keepalive_expiry=http_keepalive_expiry,
+    )
+    timeout = httpx.Timeout(30.0)
+    http_client = httpx.Client(
+        limits=limits, timeout=timeout, http2=http2_enabled,
+        event_hooks={"request": [_http_request_hook]}
+    )
+    http_async_client = httpx.AsyncClient(
+        transport=_DrainingAsyncTransport(httpx.AsyncHTTPTransport(limits=limits, http2=http2_enabled)),
+        timeout=timeout,
+        event_hooks={"request": [_http_request_hook_async]}
+    )
+    logger.info(f"HTTP pool: max {http_max_connections} connections, keep-alive {http_keepalive_expiry}s, "
+                f"HTTP/2 {'on' if http2_enabled else 'off'}")
+
+async def close_http_clients():
+    global http_client, http_async_client
+    if http_client is not None:
+        http_client.close()
+        http_client = None
+    if http_async_client is not None:
+        await http_async_client.aclose()
+        http_async_client = None
+
+def http_pool_stats() -> dict:
+    requests_sent = http_stats["requests"]
+    reused = max(requests_sent - http_stats["new_connections"], 0)
+    return {
+        "max_connections": http_max_connections,
+        "keepalive_expiry": http_keepalive_expiry,
+        "http2": http2_enabled,
+        "requests": requests_sent,
+        "new_connections": http_stats["new_connections"],
+        "reused_connections": reused,
+        "reuse_rate": round(reused / requests_sent, 4) if requests_sent else 0.0,
+    }
+
+# Single-flight state: cache key -> in-flight agent run
+inflight_requests = {}
+coalesced_requests = 0
+# Work abandoned by clients: requests whose client disconnected before the answer, and
+# agent runs cancelled because nobody was waiting for them anymore (vLLM aborts their generation)
+cancellation_stats = {"client_disconnects": 0, "agent_runs_cancelled": 0}
+
+class InflightRun:
+    """An agent run shared by all requests with the same cache key, cancelled when the last one leaves"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+# Hash of the agent prompts, part of the cache key so prompt changes never serve stale answers
+prompt_version = ""
+
+# Token budget of the compiled system prompt (0 = no limit), see prompt_compiler.py
+prompt_token_budget = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "1024"))
+# Per-section token costs of the compiled prompt, reported by /health
+prompt_report = {}
+
+class ResponseCache:
+    """In-memory response cache with TTL expiry and LRU eviction by entry count and size"""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int = 0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, response, size)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, response, size = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: str):
+        size = len(key.encode("utf-8")) + len(response.encode("utf-8"))
+        if self.max_bytes and size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, response, size)
+        self._bytes += size
+        # Evict least recently used entries until both limits hold
+        while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+response_cache = ResponseCache(cache_ttl, cache_max_entries, cache_max_bytes)
+
+def normalize_message(message: str) -> str:
+    """Normalize a message for cache lookups: fold width/case and collapse whitespace"""
+    return " ".join(unicodedata.normalize("NFKC", message).lower().split())
+
+def cache_key(message: str) -> str:
+    """Cache key from normalized message, model name and prompt version"""
+    return f"{vllm_model_name}|{prompt_version}|{normalize_message(message)}"
+
 # Request models
 class ChatRequest(BaseModel):
     message: str
 
+class TokenUsage(BaseModel):
+    llm_calls: int
+    prompt_tokens: int
+    cached_prompt_tokens: int  # Served from vLLM's prefix cache
+    computed_prompt_tokens: int  # Actually prefilled
+    completion_tokens: int
+
 class ChatResponse(BaseModel):
     raw_response: str  # Raw complete response
     tools_available: List[str]
+    usage: Optional[TokenUsage] = None  # Token usage of the agent run, None if answered without it
+
+class ChatBatchRequest(BaseModel):
+    messages: List[ChatRequest]
+
+class ChatBatchItem(BaseModel):
+    raw_response: str
+    status: str  # "ok" or "error"
+    source: str  # "direct" (answered without the agent) or "agent"
+    elapsed_ms: float
+    usage: Optional[TokenUsage] = None
+
+class ChatBatchResponse(BaseModel):
+    results: List[ChatBatchItem]  # Same order as the request messages
+    tools_available: List[str]
+    elapsed_ms: float
+
+class ToolInvokeRequest(BaseModel):
+    inputs: List[dict]  # Tool arguments per call, e.g. {"expression": "2+3*4"}
+
+class ToolInvokeItem(BaseModel):
+    result: Optional[Any] = None  # Decimal results (decimal mode) serialize as JSON strings
+    error: Optional[str] = None
+
+class ToolInvokeResponse(BaseModel):
+    tool: str
+    results: List[ToolInvokeItem]  # Same order as the request inputs
+    elapsed_ms: float
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """Sums token usage over the LLM calls of one agent run, split into cached and computed prompt tokens"""
+
+    run_inline = True
+
+    def __init__(self):
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if not usage:
+                    continue
+                self.llm_calls += 1
+                self.prompt_tokens += usage.get("input_tokens", 0)
+                self.cached_prompt_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+                self.completion_tokens += usage.get("output_tokens", 0)
+
+    def usage(self) -> TokenUsage:
+        return TokenUsage(
+            llm_calls=self.llm_calls,
+            prompt_tokens=self.prompt_tokens,
+            cached_prompt_tokens=self.cached_prompt_tokens,
+            computed_prompt_tokens=self.prompt_tokens - self.cached_prompt_tokens,
+            completion_tokens=self.completion_tokens,
+        )
+
+# Prefix cache totals over all agent runs
+prefix_cache_stats = {"prompt_tokens": 0, "cached_prompt_tokens": 0}
+
+def record_token_usage(usage: TokenUsage):
+    prefix_cache_stats["prompt_tokens"] += usage.prompt_tokens
+    prefix_cache_stats["cached_prompt_tokens"] += usage.cached_prompt_tokens
+    logger.info(f"Agent run used {usage.llm_calls} LLM calls, prompt tokens: {usage.prompt_tokens} "
+                f"({usage.cached_prompt_tokens} cached, {usage.computed_prompt_tokens} computed), "
+                f"completion tokens: {usage.completion_tokens}")
 
 # Define tool functions
 def add_numbers(a: float, b: float) -> float:
@@ -104,7 +530,7 @@ def multiply_numbers(a: float, b: float) -> float:
     logger.info(f"[Tool] multiply_numbers result: {result}")
     return result
 
-def calculate_expression(expression: str) -> float:
+def calculate_expression(expression: str) -> Union[float, decimal.Decimal]:
     """
     Calculate a mathematical expression. The expression must only contain numbers and basic operators (+, -, *, /, parentheses).
     
@@ -114,71 +540,194 @@ def calculate_expression(expression: str) -> float:
         expression: Mathematical expression string, must only contain numbers, operators, and parentheses, e.g., '2+3*4', '10/2', etc.
     
     Returns:
-        Calculation result as float
+        Calculation result as float, or as an exact Decimal in decimal mode
     """
     logger.info(f"[Tool] calculate_expression(expression='{expression}')")
     try:
-        # Simple safe calculation, only allow numbers and basic operators
-        allowed_chars = set('0123456789+-*/.() ')
-        if not all(c in allowed_chars for c in expression):
-            raise ValueError("Expression contains invalid characters")
-        
-        result = eval(expression)
-        result_float = float(result)
-        logger.info(f"[Tool] calculate_expression result: {result_float}")
-        return result_float
+        # Restricted to numbers, arithmetic operators and parentheses, with size and work limits
+        result = expression_engine.evaluate(expression, expression_mode)
+        logger.info(f"[Tool] calculate_expression result: {result}")
+        return result
     except Exception as e:
         logger.error(f"[Tool] calculate_expression failed: {str(e)}")
         raise ValueError(f"Calculation error: {str(e)}")
 
+# Arithmetic fast path: answer pure expressions deterministically without calling the LLM
+# Phrasings stripped around the expression (checked repeatedly, longest first)
+FAST_PATH_PREFIXES = [
+    '请帮我计算', '帮我计算一下', '帮我计算', '请计算一下', '请计算', '计算一下', '帮我算一下', '帮我算',
+    '算一下', '计算', '请问', '求',
+    'please calculate', 'please compute', 'calculate', 'compute', 'evaluate',
+    'how much is', "what's", 'what is',
+]
+FAST_PATH_SUFFIXES = [
+    '等于多少', '等于几', '是多少', '得多少', '等于', '的结果', '结果', '多少',
+    '=', '?', '!', '.', 'equals', 'equal to',
+]
+# Operator words, longest first so "乘以" wins over "乘"
+# Bare "除" is left out on purpose: "a除b" means b / a in Chinese, let the agent handle it
+FAST_PATH_OPERATOR_WORDS = [
+    ('multiplied by', '*'), ('divided by', '/'), ('plus', '+'), ('minus', '-'), ('times', '*'),
+    ('乘以', '*'), ('除以', '/'), ('加上', '+'), ('减去', '-'), ('加', '+'), ('减', '-'), ('乘', '*'),
+    ('×', '*'), ('÷', '/'), ('−', '-'),
+]
+_NUM = r'(-?\d+(?:\.\d+)?)'
+# Two-operand phrasings that map directly onto add_numbers / multiply_numbers
+FAST_PATH_BINARY_PATTERNS = [
+    (re.compile(rf'^(?:add|sum)\s+{_NUM}\s+(?:and|to|with)\s+{_NUM}$'), add_numbers),
+    (re.compile(rf'^(?:the\s+)?sum\s+of\s+{_NUM}\s+and\s+{_NUM}$'), add_numbers),
+    (re.compile(rf'^{_NUM}\s*(?:和|与){_NUM}\s*的和$'), add_numbers),
+    (re.compile(rf'^multiply\s+{_NUM}\s+(?:and|by|with)\s+{_NUM}$'), multiply_numbers),
+    (re.compile(rf'^(?:the\s+)?product\s+of\s+{_NUM}\s+and\s+{_NUM}$'), multiply_numbers),
+    (re.compile(rf'^{_NUM}\s*(?:和|与){_NUM}\s*的(?:乘)?积$'), multiply_numbers),
+]
+FAST_PATH_SIMPLE_BINARY = re.compile(rf'^{_NUM}([+*]){_NUM}$')
+# Dates and phone numbers (2024-10-17, 12/25/2024, 138-1234-5678) are never arithmetic
+FAST_PATH_DATE_OR_PHONE = re.compile(r'^(?:\d{2,4}([-/])\d{1,2}\1\d{1,4}|\d{3}-\d{3,4}-\d{4})$')
+# Digit groups joined only by - or / without spaces (12/25, 10-5) may be dates, fractions or
+# codes; they are answered only when the message explicitly asks for a calculation
+FAST_PATH_BARE_SEPARATED = re.compile(r'^\d+(?:[-/]\d+)+$')
+FAST_PATH_MAX_LENGTH = 200
+_CJK_CHARS = re.compile(r'[一-鿿]')
+
+def format_answer(result: Union[float, decimal.Decimal], message: str) -> str:
+    """Format a calculation result the way the system prompt asks the agent to"""
+    if isinstance(result, decimal.Decimal):
+        # All digits of the exact result, without trailing zeros or exponent
+        value = f"{result.normalize():f}"
+    elif result.is_integer() and abs(result) < 1e16:
+        value = str(int(result))
+    else:
+        value = f"{result:.12g}"
+    if _CJK_CHARS.search(message):
+        return f"答案是 {value}"
+    return f"The answer is {value}"
+
+def _strip_phrasing(text: str) -> str:
+    """Strip request phrasings around the expression until nothing changes"""
+    changed = True
+    while changed:
+        changed = False
+        text = text.strip().strip(':：,，')
+        for prefix in FAST_PATH_PREFIXES:
+            if text.startswith(prefix):
+                text = text[len(prefix):]
+                changed = True
+        for suffix in FAST_PATH_SUFFIXES:
+            if text.endswith(suffix):
+                text = text[:-len(suffix)]
+                changed = True
+    return text.strip()
+
+def fast_path_answer(message: str) -> Optional[str]:
+    """
+    Answer pure arithmetic messages without the agent.
+
+    Returns the formatted answer, or None if the message is not unambiguously
+    arithmetic and must go through the agent.
+    """
+    if len(message) > FAST_PATH_MAX_LENGTH:
+        return None
+    # NFKC folds full-width digits, operators and parentheses into ASCII
+    normalized = unicodedata.normalize('NFKC', message).lower().strip().rstrip('?!. ')
+    text = _strip_phrasing(normalized)
+    if FAST_PATH_DATE_OR_PHONE.match(text):
+        return None
+    # A request phrasing ("calculate", "what is", "等于多少", "=") was stripped
+    explicit_request = text != normalized
+    if FAST_PATH_BARE_SEPARATED.match(text) and not explicit_request:
+        return None
+
+    for pattern, tool_func in FAST_PATH_BINARY_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            return format_answer(tool_func(float(match.group(1)), float(match.group(2))), message)
+
+    for word, operator in FAST_PATH_OPERATOR_WORDS:
+        text = text.replace(word, f' {operator} ')
+    # "0x10" is a hex literal, not 0 times 10; let the agent handle it
+    if re.search(r'(?<![\d.])0x', text):
+        return None
+    # "3 x 4" means multiplication only between two numbers
+    text = re.sub(r'(?<=\d)\s*x\s*(?=\d)', '*', text)
+    expression = re.sub(r'\s+', '', text)
+
+    # Only plain expressions with at least one binary operator, same character set as calculate_expression
+    if not expression or not all(c in '0123456789+-*/.()' for c in expression):
+        return None
+    if not re.search(r'[\d)]\s*[+\-*/]', expression) or '**' in expression:
+        return None
+    try:
+        ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return None
+
+    simple = FAST_PATH_SIMPLE_BINARY.match(expression)
+    try:
+        if simple and simple.group(2) == '+':
+            result = add_numbers(float(simple.group(1)), float(simple.group(3)))
+        elif simple:
+            result = multiply_numbers(float(simple.group(1)), float(simple.group(3)))
+        else:
+            result = calculate_expression(expression)
+    except ValueError as e:
+        # Same message the agent path returns when the tool raises (e.g. division by zero)
+        return f"Error: {str(e)}"
+    return format_answer(result, message)
+
+def react_step_regex(tool_names: List[str]) -> str:
+    """
+    Regex of one ReAct step as generated after "Thought:": a thought line, then either one
+    action with a single-line input or the final answer
+    """
+    actions = "|".join(re.escape(name) for name in tool_names)
+    return (
+        r"(?:Thought: )?[^\n]*\n"
+        rf"(?:Action: (?:{actions})\nAction Input: [^\n]+|Final Answer: [\s\S]+)"
+    )
+
+def guided_decoding_body(tool_names: List[str]) -> Optional[dict]:
+    """vLLM request fields constraining ReAct steps to the step format, None when disabled"""
+    if guided_decoding == "off":
+        return None
+    regex = react_step_regex(tool_names)
+    if guided_decoding == "structured_outputs":
+        return {"structured_outputs": {"regex": regex}}
+    if guided_decoding == "guided_regex":
+        return {"guided_regex": regex}
+    raise ValueError(f"Unknown CHAT_GUIDED_DECODING={guided_decoding!r}, "
+                     f"expected off, structured_outputs or guided_regex")
+
 async def init_agent():
     """Initialize LangChain Agent"""
-    global agent_executor, tools
+    global agent_executor, tools, prompt_version, prompt_report
+
+    if expression_mode not in EXPRESSION_MODES:
+        raise ValueError(f"Unknown CHAT_EXPRESSION_MODE={expression_mode!r}, expected one of {EXPRESSION_MODES}")
     
     # 1. Create tool list
     logger.info("Creating tools...")
+    # Descriptions come from the canonical tool spec in prompt_compiler, the signature is
+    # rendered by create_react_agent, so neither is repeated in the system prompt
     tool_add = StructuredTool.from_function(
         func=add_numbers,
         name="add_numbers",
-        description="""Calculate the sum of two numbers.
-
-IMPORTANT: Only use this tool when the user explicitly requests addition calculation. For greetings, casual chat, or non-mathematical questions, DO NOT use this tool.
-
-Args:
-    a: First number
-    b: Second number
-
-Returns:
-    Sum of the two numbers"""
+        description=tool_description("add_numbers"),
+        return_direct=tool_return_direct,
     )
     
     tool_multiply = StructuredTool.from_function(
         func=multiply_numbers,
         name="multiply_numbers",
-        description="""Calculate the product of two numbers.
-
-IMPORTANT: Only use this tool when the user explicitly requests multiplication calculation. For greetings, casual chat, or non-mathematical questions, DO NOT use this tool.
-
-Args:
-    a: First number
-    b: Second number
-
-Returns:
-    Product of the two numbers"""
+        description=tool_description("multiply_numbers"),
+        return_direct=tool_return_direct,
     )
     
     tool_calculate = StructuredTool.from_function(
         func=calculate_expression,
         name="calculate_expression",
-        description="""Calculate a mathematical expression. The expression must only contain numbers and basic operators (+, -, *, /, parentheses).
-
-IMPORTANT: Only use this tool when the user explicitly requests calculation of a mathematical expression. The expression parameter must be a valid mathematical expression string (e.g., '2+3*4'), not a greeting, text, or other non-mathematical content. For greetings, casual chat, or non-mathematical questions, DO NOT use this tool.
-
-Args:
-    expression: Mathematical expression string, must only contain numbers, operators, and parentheses, e.g., '2+3*4', '10/2', etc.
-
-Returns:
-    Calculation result as float"""
+        description=tool_description("calculate_expression"),
+        return_direct=tool_return_direct,
     )
     
     tools = [tool_add, tool_multiply, tool_calculate]
@@ -192,6 +741,9 @@ Returns:
     max_retries = 15
     retry_delay = 2  # seconds
     
+    # All LLM calls share one keep-alive connection pool instead of the client defaults
+    create_http_clients()
+
     llm = None
     for attempt in range(max_retries):
         try:
@@ -203,6 +755,9 @@ Returns:
                 temperature=0.1,
                 max_tokens=256,
                 timeout=30.0,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                stream_usage=True,  # Token usage (incl. prefix cache hits) on the agent's streamed calls
             )
             
             # Test connection (via simple call)
@@ -227,94 +782,65 @@ Returns:
     if llm is None:
         raise RuntimeError("Cannot create vLLM client, please check if vLLM server is running")
     
-    # 3. Create ReAct Agent
-    logger.info("Creating LangChain ReAct Agent...")
+    # 3. Create Agent (ReAct or native tool calling, see CHAT_AGENT_MODE)
+    logger.info(f"Creating LangChain agent ({agent_mode} mode)...")
     
-    # System prompt clearly guides Agent when to use tools
-    # Reference: mcp_server.py tool descriptions to avoid infinite tool calls
-    system_prompt = """You are a friendly math calculation assistant.
-
-CRITICAL RULES - Must strictly follow (these rules prevent infinite tool calls):
-
-1. **DO NOT USE TOOLS FOR GREETINGS OR CASUAL CHAT**:
-   - If the user says greetings (like "hello", "hi", "你好", etc.), directly reply friendly, absolutely do not call any tools
-   - If the user's question doesn't involve math calculation, directly answer, do not call tools
-   - Examples of non-math questions: greetings, asking "how are you", asking about the weather, asking what you can do, etc.
-
-2. **ONLY USE TOOLS FOR EXPLICIT MATH CALCULATION REQUESTS**:
-   - Only use tools when the user explicitly requests math calculation
-   - The user must clearly ask for calculation (e.g., "calculate", "compute", "what is X + Y", "计算", etc.)
-   - If the user's intent is unclear, ask for clarification instead of calling tools
-
-3. **CALL EXACTLY ONE TOOL PER REQUEST - THEN STOP**:
-   - **Most important**: Call at most ONE tool per request
-   - After calling a tool and getting the result, immediately return the final answer and END processing
-   - Format: "The answer is [result]" or "Calculation result is [result]" or "答案是 [result]"
-   - **DO NOT** call any tools again after getting a result
-   - **DO NOT** continue iterating after getting a result
-
-Workflow (strictly follow - this prevents infinite loops):
-- Step 1: Analyze user request
-  - If it's a greeting or non-math question → directly reply friendly, END (do not use tools)
-  - If it's a math calculation request → proceed to Step 2
-- Step 2: If calculation is needed, call ONE tool (add_numbers, multiply_numbers, or calculate_expression)
-- Step 3: After getting tool result, immediately generate final reply and END
-  - Format: "The answer is [result]" or "答案是 [result]"
-  - **STOP HERE** - do not proceed further
-- **NEVER proceed to Step 4**: Do not call tools again, do not continue iterating
-
-Available tools (only use when math calculation is explicitly requested):
-- add_numbers(a, b): Add two numbers. IMPORTANT: Only use when user explicitly requests addition.
-- multiply_numbers(a, b): Multiply two numbers. IMPORTANT: Only use when user explicitly requests multiplication.
-- calculate_expression(expression): Calculate mathematical expression (only supports numbers and basic operators, like +-*/). IMPORTANT: Only use when user explicitly requests expression calculation.
-
-Correct examples (these are just explanations, do not execute):
-- User says "你好" or "hello" → directly reply "你好！我是数学计算助手..." (do not use tools)
-- User says "Calculate 5 + 3" → call add_numbers(5, 3) once, get result 8, reply "The answer is 8", END
-- User says "4 * 7" → call multiply_numbers(4, 7) once, get result 28, reply "The answer is 28", END
-- User says "计算 2+3*4" → call calculate_expression("2+3*4") once, get result 14, reply "答案是 14", END
-
-**ABSOLUTELY FORBIDDEN** (these cause infinite loops):
-- Calling any tools for greetings or non-math questions
-- Calling any tools again after calling a tool and getting a result
-- Continuing iteration after getting tool result
-- Calling multiple tools for the same calculation problem
-- Calling tools when user intent is unclear (ask for clarification instead)"""
-    
-    # Use built-in ReAct prompt (doesn't depend on langchain-hub)
-    # Note: {tools}, {tool_names}, {agent_scratchpad}, {input} are automatically handled by create_react_agent
-    # We only need to partially fill system_prompt
-    prompt_template = """You are a friendly math calculation assistant.
-
-{system_prompt}
-
-You have access to the following tools:
-
-{tools}
-
-Use the following format:
-
-Question: the input question you need to answer
-Thought: you should think about what to do
-Action: the action to take, should be one of [{tool_names}]
-Action Input: the input to the action
-Observation: the result of the action
-... (this Thought/Action/Action Input/Observation can repeat N times)
-Thought: I now know the final answer
-Final Answer: the final answer to the original input question
+    # System prompt compiled from the canonical tool spec, counted with the model's tokenizer
+    # and kept within the token budget (optional sections are dropped first)
+    # Note: {tools}, {tool_names}, {agent_scratchpad}, {input} are filled in by the agent constructor
+    # Layout for vLLM prefix caching: everything static (instructions, tools, format) is the
+    # system message, rendered byte-identically on every request and agent iteration; only the
+    # user turn (question + scratchpad) varies, so prefill is limited to it
+    tokenize_url = re.sub(r"/v1/?$", "", vllm_server_url) + "/tokenize"
+    compiled = await compile_prompt(
+        tools,
+        prompt_token_budget,
+        lambda texts: count_tokens(texts, tokenize_url, vllm_model_name, http_async_client),
+        mode=agent_mode,
+    )
+    prompt_template = compiled["template"]
+    prompt_report = compiled["report"]
+    logger.info(
+        f"System prompt: {prompt_report['total_tokens']} tokens "
+        f"({'estimated' if prompt_report['estimated'] else 'tokenizer'}), budget {prompt_report['budget'] or 'none'}, "
+        f"sections {prompt_report['sections']}, dropped {prompt_report['dropped']}"
+    )
+    if agent_mode == "tools":
+        # Tools go out as OpenAI tool schemas and come back as structured tool_calls, so a
+        # calculation is one tool call plus one answer and nothing has to be parsed from text
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompt_template),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad"),
+        ])
+        agent = create_tool_calling_agent(llm, tools, prompt)
+    else:
+        user_turn_template = """Question: {input}
+Thought: {agent_scratchpad}"""
 
-Begin!
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", prompt_template),
+            ("human", user_turn_template),
+        ])
+        # Stop sequences (and optionally guided decoding) end each step once the action or
+        # final answer is out, so no tokens go to hallucinated observations and parse retries
+        react_llm = llm
+        guided_body = guided_decoding_body([t.name for t in tools])
+        if guided_body:
+            react_llm = llm.bind(extra_body=guided_body)
+        logger.info(f"ReAct stop sequences: {react_stop_sequences}, guided decoding: {guided_decoding}")
+        # Create ReAct Agent (using langchain_classic, based on source code)
+        # According to source code: create_react_agent returns a Runnable, needs to be used with AgentExecutor
+        agent = create_react_agent(react_llm, tools, prompt, stop_sequence=react_stop_sequences)
 
-Question: {input}
-Thought: {agent_scratchpad}"""
-    
-    prompt = PromptTemplate.from_template(prompt_template)
-    # Partially fill system_prompt, other variables are handled by create_react_agent
-    prompt = prompt.partial(system_prompt=system_prompt)
-    
-    # Create ReAct Agent (using langchain_classic, based on source code)
-    # According to source code: create_react_agent returns a Runnable, needs to be used with AgentExecutor
-    agent = create_react_agent(llm, tools, prompt)
+    # The rendered static prefix (with tool descriptions or schemas) identifies the prompt version
+    static_prefix = compiled["rendered"]
+    # Mode, direct return and guided decoding change the answers too, so they are part of the version
+    prompt_version = hashlib.sha256(
+        f"{agent_mode}|{tool_return_direct}|{guided_decoding}|{static_prefix}".encode("utf-8")
+    ).hexdigest()[:12]
+    logger.info(f"Agent mode: {agent_mode}, tool return direct: {tool_return_direct}, "
+                f"prompt version: {prompt_version} (static prefix {len(static_prefix)} chars)")
     
     # Create AgentExecutor
     # For small models (1.5B), we need more iterations to handle format errors
@@ -322,6 +848,7 @@ Thought: {agent_scratchpad}"""
     # - Iteration 2: Retry or Observation + Thought
     # - Iteration 3: Final Answer
     # max_iterations=3 allows for one retry if format parsing fails
+    # (tools mode needs 2: one tool call, then the answer)
     agent_executor = AgentExecutor(
         agent=agent,
         tools=tools,
@@ -338,6 +865,177 @@ async def get_tool_names() -> List[str]:
     """Get list of available tool names"""
     return [tool.name for tool in tools]
 
+@asynccontextmanager
+async def agent_slot():
+    """Hold one of the agent concurrency slots, recording the run latency for admission control"""
+    global agent_running, agent_waiting
+    agent_waiting += 1
+    try:
+        await agent_semaphore.acquire()
+    finally:
+        agent_waiting -= 1
+    agent_running += 1
+    start_time = time.monotonic()
+    try:
+        yield
+        admission.record_latency(time.monotonic() - start_time)
+    finally:
+        agent_running -= 1
+        agent_semaphore.release()
+
+def cache_agent_response(key: str, raw_response: str):
+    # Only cache real answers, not empty output or the executor's give-up message
+    if response_cache.enabled and raw_response.strip() and not raw_response.startswith("Agent stopped"):
+        response_cache.put(key, raw_response)
+
+def agent_output(output: Any, message: str) -> str:
+    """Response text of an agent run, a directly returned tool result is formatted like the fast path"""
+    if isinstance(output, decimal.Decimal):
+        return format_answer(output, message)
+    if isinstance(output, (int, float)) and not isinstance(output, bool):
+        return format_answer(float(output), message)
+    return str(output)
+
+async def run_agent(message: str, key: str) -> tuple:
+    """Run the agent on a message, returning (answer or error message, token usage)"""
+    # Use LangChain Agent to process request (automatically handles tool calls)
+    # The async path uses ChatOpenAI's async client, no thread is held per request;
+    # the semaphore queues runs beyond vLLM's batch capacity
+    usage_handler = TokenUsageHandler()
+    try:
+        async with agent_slot():
+            result = await agent_executor.ainvoke({"input": message}, config={"callbacks": [usage_handler]})
+        
+        # Get response text
+        if isinstance(result, dict) and "output" in result:
+            raw_response = agent_output(result["output"], message)
+        else:
+            raw_response = str(result)
+
+        cache_agent_response(key, raw_response)
+        
+    except asyncio.TimeoutError:
+        logger.warning("Agent processing timeout")
+        raw_response = "Timeout error: Agent processing timeout"
+    except Exception as e:
+        logger.error(f"Agent execution error: {e}", exc_info=True)
+        raw_response = f"Error: {str(e)}"
+
+    usage = usage_handler.usage()
+    record_token_usage(usage)
+    return raw_response, usage
+
+def route_message(message: str, key: str) -> Optional[str]:
+    """
+    Answer a message without running the agent when possible.
+
+    Handles empty input, non-math messages, pure arithmetic and cached answers;
+    returns None if the message needs an agent run.
+    """
+    # Input validation: check if message is empty or too short
+    if not message or len(message) < 2:
+        return "Input message is too short or empty"
+    
+    # Use whitelist: only call LLM if contains math calculation keywords
+    user_message_lower = message.lower()
+    math_keywords = ['计算', '算', '加', '减', '乘', '除', '等于', '等于多少', '+', '-', '*', '/', 'calculate', 'compute', 'add', 'multiply', 'divide']
+    has_math_content = any(keyword in user_message_lower for keyword in math_keywords) or \
+                      any(char.isdigit() for char in user_message_lower)
+    
+    # If doesn't contain math content, directly reply friendly, don't call Agent
+    if not has_math_content:
+        logger.info("No math calculation content detected, directly replying, not calling Agent")
+        return "Hello! I am a math calculation assistant, I can help you with math calculations. Please tell me what you need to calculate?"
+
+    # Pure arithmetic is answered directly, only ambiguous messages reach the agent
+    fast_answer = fast_path_answer(message)
+    if fast_answer is not None:
+        logger.info(f"Arithmetic fast path answered: {fast_answer}")
+        return fast_answer
+
+    # Repeated questions are served from the response cache
+    if response_cache.enabled:
+        cached_response = response_cache.get(key)
+        if cached_response is not None:
+            logger.info("Response cache hit")
+            return cached_response
+    return None
+
+def check_admission(x_priority: Optional[str], default_priority: str = admission_default_priority):
+    """Raise 429 with Retry-After if a new agent run would miss its priority class deadline"""
+    priority = (x_priority or default_priority).strip().lower()
+    if priority not in admission.deadlines:
+        priority = admission_default_priority
+    retry_after = admission.admit(priority, agent_running, agent_waiting)
+    if retry_after is not None:
+        logger.warning(f"Rejecting {priority} priority request, expected wait exceeds "
+                       f"{admission.deadlines[priority]}s deadline")
+        raise HTTPException(
+            status_code=429,
+            detail="Server overloaded, please retry later",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+async def run_agent_coalesced(key: str, message: str) -> tuple:
+    """Single-flight: concurrent requests with the same cache key attach to one in-flight agent run"""
+    global coalesced_requests
+    run = inflight_requests.get(key)
+    if run is not None:
+        coalesced_requests += 1
+        logger.info("Attaching to in-flight agent run for identical request")
+    else:
+        run = InflightRun(asyncio.create_task(run_agent(message, key)))
+        inflight_requests[key] = run
+        run.task.add_done_callback(lambda _: release_inflight_run(key, run))
+
+    run.waiters += 1
+    try:
+        # shield: one waiter going away must not cancel the run for the others
+        return await asyncio.shield(run.task)
+    finally:
+        run.waiters -= 1
+        if run.waiters == 0 and not run.task.done():
+            # Nobody is waiting anymore: stop the run, which aborts the in-flight vLLM request
+            # so vLLM frees the sequence; new requests start a fresh run
+            logger.info("All requests for an in-flight agent run are gone, cancelling it")
+            cancellation_stats["agent_runs_cancelled"] += 1
+            release_inflight_run(key, run)
+            run.task.cancel()
+
+def release_inflight_run(key: str, run: InflightRun):
+    if inflight_requests.get(key) is run:
+        del inflight_requests[key]
+
+async def wait_for_disconnect(request: Request):
+    """Returns once the client has closed the connection (the request body is already read)"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def until_disconnect(request: Request, coro) -> tuple:
+    """
+    Run coro until it finishes or the client disconnects.
+
+    Returns (result, disconnected); on disconnect coro is cancelled, which releases its
+    agent runs (see run_agent_coalesced).
+    """
+    work = asyncio.ensure_future(coro)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({work, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not work.done():
+            work.cancel()
+    if work not in done:
+        # Let the cancellation unwind, so agent slots are released before we return
+        await asyncio.gather(work, return_exceptions=True)
+        cancellation_stats["client_disconnects"] += 1
+        logger.info("Client disconnected, cancelled its request")
+        return None, True
+    return work.result(), False
+
 @app.get("/health")
 async def health():
     """Health check"""
@@ -348,11 +1046,35 @@ async def health():
         "status": "healthy",
         "agent_loaded": agent_executor is not None,
         "vllm_available": vllm_available,
-        "tools_count": len(tool_names)
+        "tools_count": len(tool_names),
+        "agent_mode": agent_mode,
+        "prompt_version": prompt_version,
+        "prompt": prompt_report,
+        "cache": response_cache.stats(),
+        "inflight": {
+            "active": len(inflight_requests),
+            "coalesced": coalesced_requests,
+            "client_disconnects": cancellation_stats["client_disconnects"],
+            "cancelled_runs": cancellation_stats["agent_runs_cancelled"]
+        },
+        "agent_concurrency": {
+            "limit": agent_concurrency,
+            "running": agent_running,
+            "waiting": agent_waiting
+        },
+        "admission": admission.stats(agent_running, agent_waiting),
+        "http_pool": http_pool_stats(),
+        "expression_engine": dict(expression_engine.stats(), mode=expression_mode),
+        "prefix_cache": {
+            "prompt_tokens": prefix_cache_stats["prompt_tokens"],
+            "cached_prompt_tokens": prefix_cache_stats["cached_prompt_tokens"],
+            "hit_rate": round(prefix_cache_stats["cached_prompt_tokens"] / prefix_cache_stats["prompt_tokens"], 4)
+            if prefix_cache_stats["prompt_tokens"] else 0.0
+        }
     }
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request, x_priority: Optional[str] = Header(None)):
     """Chat interface"""
     if agent_executor is None:
         raise HTTPException(status_code=500, detail="Agent not initialized")
@@ -360,72 +1082,39 @@ async def chat(request: ChatRequest):
     try:
         logger.info(f"Received message: {request.message}")
         
-        # Input validation: check if message is empty or too short
         message = request.message.strip()
-        if not message or len(message) < 2:
-            tool_names = await get_tool_names()
-            raw_response = "Input message is too short or empty"
-            return ChatResponse(
-                raw_response=raw_response,
-                tools_available=tool_names
-            )
-        
-        # Use whitelist: only call LLM if contains math calculation keywords
-        user_message_lower = message.lower()
-        math_keywords = ['计算', '算', '加', '减', '乘', '除', '等于', '等于多少', '+', '-', '*', '/', 'calculate', 'compute', 'add', 'multiply', 'divide']
-        has_math_content = any(keyword in user_message_lower for keyword in math_keywords) or \
-                          any(char.isdigit() for char in user_message_lower)
-        
-        # If doesn't contain math content, directly reply friendly, don't call Agent
-        if not has_math_content:
-            logger.info("No math calculation content detected, directly replying, not calling Agent")
-            tool_names = await get_tool_names()
-            raw_response = "Hello! I am a math calculation assistant, I can help you with math calculations. Please tell me what you need to calculate?"
-            return ChatResponse(
-                raw_response=raw_response,
-                tools_available=tool_names
-            )
-        
-        # Use LangChain Agent to process request (automatically handles tool calls)
-        # AgentExecutor is synchronous, needs to run in async environment
-        try:
-            # Run synchronous AgentExecutor in async environment
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None,
-                lambda: agent_executor.invoke({"input": message})
-            )
-            
-            # Get response text
-            if isinstance(result, dict) and "output" in result:
-                raw_response = result["output"]
-            else:
-                raw_response = str(result)
-            
-        except asyncio.TimeoutError:
-            logger.warning("Agent processing timeout")
-            tool_names = await get_tool_names()
-            raw_response = "Timeout error: Agent processing timeout"
-            return ChatResponse(
-                raw_response=raw_response,
-                tools_available=tool_names
-            )
-        except Exception as e:
-            logger.error(f"Agent execution error: {e}", exc_info=True)
+        key = cache_key(message)
+        quick_response = route_message(message, key)
+        if quick_response is not None:
             tool_names = await get_tool_names()
-            raw_response = f"Error: {str(e)}"
             return ChatResponse(
-                raw_response=raw_response,
+                raw_response=quick_response,
                 tools_available=tool_names
             )
-        
+
+        # Shed load before queueing a new agent run that would miss its deadline;
+        # requests joining an in-flight run add no load and are always admitted
+        if key not in inflight_requests:
+            check_admission(x_priority)
+
+        # Identical concurrent requests share one agent run; a client that disconnects
+        # stops waiting, and the run is cancelled once no request waits for it
+        result, disconnected = await until_disconnect(http_request, run_agent_coalesced(key, message))
+        if disconnected:
+            # 499 Client Closed Request, nobody reads it
+            return Response(status_code=499)
+        raw_response, usage = result
+
         # Get available tools list
         tool_names = await get_tool_names()
         
         return ChatResponse(
             raw_response=raw_response,
-            tools_available=tool_names
+            tools_available=tool_names,
+            usage=usage
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing request: {e}", exc_info=True)
         tool_names = await get_tool_names()
@@ -435,6 +1124,189 @@ async def chat(request: ChatRequest):
             tools_available=tool_names
         )
 
+# ReAct marker after which the model's tokens are the answer shown to the user
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+def sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+async def stream_final_response(raw_response: str):
+    """SSE stream for a response that didn't need the agent"""
+    tool_names = await get_tool_names()
+    yield sse_event("final", {"raw_response": raw_response, "tools_available": tool_names})
+
+async def stream_agent(message: str, key: str):
+    """
+    Run the agent and yield SSE events as it goes.
+
+    Events: tool_call / observation for each tool use, token for final-answer tokens as
+    vLLM generates them, then final with the complete response (or error).
+    """
+    tool_names = await get_tool_names()
+    raw_response = None
+    usage_handler = TokenUsageHandler()
+    try:
+        async with agent_slot():
+            llm_text = {}  # LLM run id -> text generated so far
+            async for event in agent_executor.astream_events(
+                {"input": message}, config={"callbacks": [usage_handler]}, version="v2"
+            ):
+                kind = event["event"]
+                if kind == "on_chat_model_stream":
+                    chunk = event["data"]["chunk"].content
+                    if not chunk:
+                        continue
+                    if agent_mode == "tools":
+                        # Tool calls stream as tool_call_chunks, text content is the answer
+                        yield sse_event("token", {"text": chunk})
+                        continue
+                    before = llm_text.get(event["run_id"], "")
+                    text = before + chunk
+                    llm_text[event["run_id"]] = text
+                    # Thoughts and actions are not forwarded, only what follows the final answer marker
+                    marker = text.find(FINAL_ANSWER_MARKER)
+                    if marker >= 0:
+                        token = text[max(marker + len(FINAL_ANSWER_MARKER), len(before)):]
+                        if token:
+                            yield sse_event("token", {"text": token})
+                elif kind == "on_chain_stream" and not event["parent_ids"]:
+                    # AgentExecutor's own chunks: planned actions, tool results, final output
+                    # (tools named "_..." are LangChain's internal parsing-error handlers)
+                    chunk = event["data"]["chunk"]
+                    for action in chunk.get("actions", []):
+                        if not action.tool.startswith("_"):
+                            yield sse_event("tool_call", {"name": action.tool, "input": action.tool_input})
+                    for step in chunk.get("steps", []):
+                        if not step.action.tool.startswith("_"):
+                            yield sse_event("observation", {"name": step.action.tool, "output": step.observation})
+                    if "output" in chunk:
+                        raw_response = chunk["output"]
+                elif kind == "on_chain_end" and not event["parent_ids"]:
+                    # The final output chunk may be emitted after the run ends, or not at all
+                    output = event["data"].get("output")
+                    if isinstance(output, dict) and "output" in output:
+                        raw_response = output["output"]
+    except asyncio.CancelledError:
+        # The client disconnected: the response stream is cancelled and with it the
+        # in-flight vLLM request
+        cancellation_stats["client_disconnects"] += 1
+        cancellation_stats["agent_runs_cancelled"] += 1
+        logger.info("Streaming client disconnected, cancelled the agent run")
+        raise
+    except Exception as e:
+        logger.error(f"Agent execution error: {e}", exc_info=True)
+        yield sse_event("error", {"raw_response": f"Error: {str(e)}", "tools_available": tool_names})
+        return
+
+    usage = usage_handler.usage()
+    record_token_usage(usage)
+    if raw_response is None:
+        # Neither the output chunk nor the root chain end carried the answer
+        logger.error("Agent stream ended without a final output")
+        yield sse_event("error", {"raw_response": "Error: agent returned no output", "tools_available": tool_names,
+                                  "usage": usage.model_dump()})
+        return
+    raw_response = agent_output(raw_response, message)
+    cache_agent_response(key, raw_response)
+    yield sse_event("final", {"raw_response": raw_response, "tools_available": tool_names,
+                              "usage": usage.model_dump()})
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, x_priority: Optional[str] = Header(None)):
+    """Streaming chat interface (Server-Sent Events)"""
+    if agent_executor is None:
+        raise HTTPException(status_code=500, detail="Agent not initialized")
+
+    logger.info(f"Received streaming message: {request.message}")
+    message = request.message.strip()
+    key = cache_key(message)
+    quick_response = route_message(message, key)
+    if quick_response is not None:
+        events = stream_final_response(quick_response)
+    else:
+        # Streams are not coalesced, each client needs its own token stream
+        check_admission(x_priority)
+        events = stream_agent(message, key)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def is_error_response(raw_response: str) -> bool:
+    """True for the error messages run_agent and the fast path return instead of raising"""
+    return raw_response.startswith(("Error:", "Timeout error:"))
+
+def batch_item(raw_response: str, source: str, start_time: float,
+               usage: Optional[TokenUsage] = None) -> ChatBatchItem:
+    return ChatBatchItem(
+        raw_response=raw_response,
+        status="error" if is_error_response(raw_response) else "ok",
+        source=source,
+        elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2),
+        usage=usage
+    )
+
+async def run_batch_agent_item(message: str, key: str, batch_semaphore: asyncio.Semaphore) -> ChatBatchItem:
+    start_time = time.perf_counter()
+    async with batch_semaphore:
+        raw_response, usage = await run_agent_coalesced(key, message)
+    return batch_item(raw_response, "agent", start_time, usage)
+
+@app.post("/chat/batch", response_model=ChatBatchResponse)
+async def chat_batch(request: ChatBatchRequest, http_request: Request, x_priority: Optional[str] = Header(None)):
+    """Batch chat interface: answers all messages concurrently, results in request order"""
+    if agent_executor is None:
+        raise HTTPException(status_code=500, detail="Agent not initialized")
+    if len(request.messages) > batch_max_size:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large: {len(request.messages)} messages, max {batch_max_size}"
+        )
+
+    start_time = time.perf_counter()
+    logger.info(f"Received batch of {len(request.messages)} messages")
+
+    # Cheap path first: greetings, arithmetic and cached answers never reach the agent
+    results: List[Optional[ChatBatchItem]] = []
+    agent_items = []  # (index, message, cache key)
+    for item in request.messages:
+        item_start = time.perf_counter()
+        message = item.message.strip()
+        key = cache_key(message)
+        quick_response = route_message(message, key)
+        if quick_response is not None:
+            results.append(batch_item(quick_response, "direct", item_start))
+        else:
+            agent_items.append((len(results), message, key))
+            results.append(None)
+
+    if agent_items:
+        # Admitted on the queue ahead of its first wave, against the (by default low priority)
+        # deadline; the batch's own later waves are paced by batch_semaphore, not rejected.
+        # Agent slots are served in arrival order, so priority only changes the admission
+        # threshold, not the queue position
+        batch_parallel = min(batch_max_concurrency, len(agent_items))
+        check_admission(x_priority, batch_default_priority)
+        # At most batch_parallel runs of this batch hold or wait for agent slots at a time, so
+        # interactive requests queue behind a few batch runs instead of the whole batch
+        batch_semaphore = asyncio.Semaphore(batch_parallel)
+        agent_results, disconnected = await until_disconnect(http_request, asyncio.gather(
+            *[run_batch_agent_item(message, key, batch_semaphore) for _, message, key in agent_items]
+        ))
+        if disconnected:
+            return Response(status_code=499)
+        for (index, _, _), result in zip(agent_items, agent_results):
+            results[index] = result
+
+    tool_names = await get_tool_names()
+    return ChatBatchResponse(
+        results=results,
+        tools_available=tool_names,
+        elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2)
+    )
+
 @app.get("/tools")
 async def list_tools():
     """List available tools"""
@@ -447,6 +1319,37 @@ async def list_tools():
         })
     return {"tools": tools_list}
 
+def invoke_tool_batch(tool: Any, inputs: List[dict]) -> List[ToolInvokeItem]:
+    """Run a tool on each input, a failing input doesn't affect the others"""
+    results = []
+    for tool_input in inputs:
+        try:
+            results.append(ToolInvokeItem(result=tool.invoke(tool_input)))
+        except (ValueError, TypeError) as e:
+            results.append(ToolInvokeItem(error=str(e)))
+    return results
+
+@app.post("/tools/{name}/invoke", response_model=ToolInvokeResponse)
+async def invoke_tool(name: str, request: ToolInvokeRequest):
+    """Invoke a tool directly on many inputs, without the agent or the LLM"""
+    tool = next((t for t in tools if t.name == name), None)
+    if tool is None:
+        raise HTTPException(status_code=404, detail=f"Unknown tool: {name}")
+    if len(request.inputs) > batch_max_size:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large: {len(request.inputs)} inputs, max {batch_max_size}"
+        )
+
+    start_time = time.perf_counter()
+    # CPU-bound, run off the event loop so a large batch doesn't stall other requests
+    results = await asyncio.to_thread(invoke_tool_batch, tool, request.inputs)
+    return ToolInvokeResponse(
+        tool=name,
+        results=results,
+        elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2)
+    )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
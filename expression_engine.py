@@ -0,0 +1,156 @@
+"""
+Expression engine - safe, cached arithmetic evaluation for calculate_expression
+
+Expressions are parsed into a restricted AST (numbers, + - * / // ** and parentheses),
+compiled into nested closures and kept in an LRU cache, so repeated expressions skip
+parsing and validation. Limits on expression length, number of AST nodes, literal size
+and result magnitude bound the work per expression (e.g. 9**9**9 fails fast instead of
+computing a huge integer).
+
+Modes:
+    float:   IEEE floats, the default
+    decimal: exact decimal literals and arithmetic (0.1 + 0.2 == 0.3), precision and
+             exponent range set by the engine's decimal context
+"""
+import ast
+import decimal
+import math
+import operator
+import threading
+from collections import OrderedDict
+from typing import Callable, Union
+
+# Same character set calculate_expression has always accepted
+ALLOWED_CHARS = set('0123456789+-*/.() ')
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Pow: operator.pow,
+}
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+MODES = ("float", "decimal")
+
+class ExpressionError(ValueError):
+    """Expression is invalid, exceeds a limit or cannot be evaluated"""
+
+class ExpressionEngine:
+    """Parses, validates, compiles and caches arithmetic expressions"""
+
+    def __init__(self, cache_size: int = 1024, max_length: int = 1000, max_nodes: int = 256,
+                 max_literal_digits: int = 64, max_magnitude: float = 1e300, decimal_precision: int = 28):
+        self.cache_size = cache_size
+        self.max_length = max_length
+        self.max_nodes = max_nodes
+        self.max_literal_digits = max_literal_digits
+        self.max_magnitude = max_magnitude
+        # Overflow, division by zero and invalid operations raise instead of returning Infinity/NaN
+        exponent = int(math.log10(max_magnitude))
+        self.decimal_context = decimal.Context(
+            prec=decimal_precision, Emax=exponent, Emin=-exponent,
+            traps=[decimal.Overflow, decimal.DivisionByZero, decimal.InvalidOperation],
+        )
+        self._cache = OrderedDict()  # (mode, expression) -> compiled closure
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, expression: str, mode: str = "float") -> Callable:
+        """Compiled form of an expression, from the LRU cache when it was seen before"""
+        if mode not in MODES:
+            raise ExpressionError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        key = (mode, expression)
+        with self._lock:
+            compiled = self._cache.get(key)
+            if compiled is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = self._compile_node(self._parse(expression).body, expression, mode)
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[key] = compiled
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return compiled
+
+    def evaluate(self, expression: str, mode: str = "float") -> Union[float, decimal.Decimal]:
+        """Evaluate an expression, raises ExpressionError with the reason on failure"""
+        compiled = self.compile(expression, mode)
+        try:
+            if mode == "decimal":
+                with decimal.localcontext(self.decimal_context):
+                    result = compiled()
+            else:
+                result = compiled()
+        except ZeroDivisionError:
+            raise ExpressionError("division by zero")
+        except decimal.DivisionByZero:
+            raise ExpressionError("division by zero")
+        except (OverflowError, decimal.Overflow):
+            raise ExpressionError("result out of range")
+        except decimal.InvalidOperation:
+            raise ExpressionError("invalid operation")
+        if isinstance(result, complex):
+            raise ExpressionError("result is not a real number")
+        if not (abs(result) <= self.max_magnitude):
+            raise ExpressionError("result out of range")
+        return result
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cache_size": self.cache_size,
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _parse(self, expression: str) -> ast.Expression:
+        if len(expression) > self.max_length:
+            raise ExpressionError(f"Expression longer than {self.max_length} characters")
+        if not all(c in ALLOWED_CHARS for c in expression):
+            raise ExpressionError("Expression contains invalid characters")
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except (SyntaxError, RecursionError, MemoryError):
+            raise ExpressionError("Invalid expression syntax")
+        # Numbers and operations, bounds the work of one evaluation
+        nodes = sum(1 for node in ast.walk(tree) if isinstance(node, ast.expr))
+        if nodes > self.max_nodes:
+            raise ExpressionError(f"Expression too complex ({nodes} nodes, limit {self.max_nodes})")
+        return tree
+
+    def _compile_node(self, node: ast.AST, expression: str, mode: str) -> Callable:
+        """Restricted AST node -> closure computing its value"""
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            op = BINARY_OPERATORS[type(node.op)]
+            left = self._compile_node(node.left, expression, mode)
+            right = self._compile_node(node.right, expression, mode)
+            return lambda: op(left(), right())
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            op = UNARY_OPERATORS[type(node.op)]
+            operand = self._compile_node(node.operand, expression, mode)
+            return lambda: op(operand())
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = self._literal(node, expression, mode)
+            return lambda: value
+        raise ExpressionError(f"Unsupported element in expression: {type(node).__name__}")
+
+    def _literal(self, node: ast.Constant, expression: str, mode: str) -> Union[float, decimal.Decimal]:
+        source = ast.get_source_segment(expression.strip(), node)
+        if len(source.replace('.', '').lstrip('0')) > self.max_literal_digits:
+            raise ExpressionError(f"Number longer than {self.max_literal_digits} digits")
+        if mode == "decimal":
+            # From the source text, so 0.1 is exactly one tenth
+            return decimal.Decimal(source)
+        return float(node.value)
@@ -1,35 +1,13 @@
 #!/usr/bin/env python3
 """
 Fix vLLM CPU attention backend: add error handling and fallback for reshape_and_cache
+
+Hunk definitions only, applied by patch_vllm.py
 """
-import os
 import sys
 
-def patch_cpu_attn():
-    """Add error handling for write_to_paged_cache in vLLM's cpu_attn.py"""
-    # Find vllm.v1.attention.backends.cpu_attn file
-    cpu_attn_path = None
-    for path in sys.path:
-        test_path = os.path.join(path, 'vllm', 'v1', 'attention', 'backends', 'cpu_attn.py')
-        if os.path.exists(test_path):
-            cpu_attn_path = test_path
-            break
-    
-    if not cpu_attn_path:
-        print('Warning: vllm.v1.attention.backends.cpu_attn.py not found')
-        return False
-    
-    # Read file content
-    with open(cpu_attn_path, 'r') as f:
-        content = f.read()
-    
-    # Check if patch already applied
-    if 'def _reshape_and_cache_fallback' in content:
-        print(f'Patch already applied to {cpu_attn_path}')
-        return True
-    
-    # Find code to replace
-    old_write_to_paged_cache = '''    @staticmethod
+# Code to replace
+OLD_WRITE_TO_PAGED_CACHE = '''    @staticmethod
     def write_to_paged_cache(
         key: torch.Tensor,
         value: torch.Tensor,
@@ -51,9 +29,114 @@ def patch_cpu_attn():
             k_scale,
             v_scale,
         )'''
+
+# New code (add error handling and PyTorch fallback)
+NEW_WRITE_TO_PAGED_CACHE = '''    # Native vs fallback kernel counters per op, written to a side file
+    # (VLLM_CPU_KERNEL_STATS_FILE, empty to disable) so degraded replicas can be alerted on
+    _kernel_stats: dict = {}
+    _kernel_stats_last_flush: float = 0.0
+    _KERNEL_STATS_FLUSH_INTERVAL: float = 10.0
+    
+    @staticmethod
+    def _record_kernel_call(op: str, path: str, elapsed: float, reason: str | None = None) -> None:
+        """Count a native/fallback call of op, remember the first fallback reason"""
+        import time
+        stats = _PagedAttention._kernel_stats.get(op)
+        if stats is None:
+            stats = _PagedAttention._kernel_stats[op] = {
+                "native_calls": 0,
+                "native_time_s": 0.0,
+                "fallback_calls": 0,
+                "fallback_time_s": 0.0,
+                "first_failure": None,
+            }
+        stats[path + "_calls"] += 1
+        stats[path + "_time_s"] += elapsed
+        flush = stats[path + "_calls"] == 1
+        if reason is not None and stats["first_failure"] is None:
+            import logging
+            stats["first_failure"] = reason
+            logging.getLogger(__name__).warning(
+                "%s is using the PyTorch fallback kernel: %s", op, reason)
+            flush = True
+        now = time.monotonic()
+        if flush or now - _PagedAttention._kernel_stats_last_flush >= _PagedAttention._KERNEL_STATS_FLUSH_INTERVAL:
+            _PagedAttention._kernel_stats_last_flush = now
+            _PagedAttention._flush_kernel_stats()
+    
+    @staticmethod
+    def _flush_kernel_stats() -> None:
+        """Atomically write the kernel counters as JSON, never failing the forward pass"""
+        import json
+        import os
+        import time
+        path = os.environ.get("VLLM_CPU_KERNEL_STATS_FILE", "/tmp/vllm_cpu_kernel_stats.json")
+        if not path:
+            return
+        # "{pid}" in the path keeps one file per worker process
+        path = path.replace("{pid}", str(os.getpid()))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({
+                    "pid": os.getpid(),
+                    "updated_at": time.time(),
+                    "ops": _PagedAttention._kernel_stats,
+                }, f, indent=2)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    
+    @staticmethod
+    def _kv_cache_storage_dtype(kv_cache_dtype: str) -> torch.dtype | None:
+        """Element type of a quantized KV cache, None for a full-precision ("auto") cache"""
+        if kv_cache_dtype == "auto":
+            return None
+        if kv_cache_dtype in ("fp8", "fp8_e4m3"):
+            return torch.float8_e4m3fn
+        if kv_cache_dtype == "fp8_e5m2":
+            return torch.float8_e5m2
+        if kv_cache_dtype == "int8":
+            return torch.int8
+        raise ValueError(f"Unsupported kv_cache_dtype for the PyTorch fallback: {kv_cache_dtype}")
+    
+    @staticmethod
+    def _quantize_kv(
+        x: torch.Tensor,
+        scale: torch.Tensor,
+        kv_cache_dtype: str,
+        cache_dtype: torch.dtype,
+    ) -> torch.Tensor:
+        """Quantize x / scale into the cache element type, returned as cache_dtype"""
+        storage_dtype = _PagedAttention._kv_cache_storage_dtype(kv_cache_dtype)
+        if storage_dtype is None:
+            return x
+        scaled = x.float() / scale
+        if storage_dtype == torch.int8:
+            quantized = scaled.round().clamp(-128, 127).to(torch.int8)
+        else:
+            finfo = torch.finfo(storage_dtype)
+            quantized = scaled.clamp(finfo.min, finfo.max).to(storage_dtype)
+        # vLLM allocates fp8 caches as uint8, reinterpret the bytes
+        if quantized.dtype != cache_dtype:
+            quantized = quantized.view(cache_dtype)
+        return quantized
+    
+    @staticmethod
+    def _dequantize_kv(
+        x: torch.Tensor,
+        scale: torch.Tensor,
+        kv_cache_dtype: str,
+    ) -> torch.Tensor:
+        """Dequantize cache entries to float32 (x * scale), plain upcast for "auto" caches"""
+        storage_dtype = _PagedAttention._kv_cache_storage_dtype(kv_cache_dtype)
+        if storage_dtype is None:
+            return x.float()
+        if x.dtype != storage_dtype:
+            x = x.view(storage_dtype)
+        return x.float() * scale
     
-    # New code (add error handling and PyTorch fallback)
-    new_write_to_paged_cache = '''    @staticmethod
+    @staticmethod
     def _reshape_and_cache_fallback(
         key: torch.Tensor,
         value: torch.Tensor,
@@ -65,7 +148,8 @@ def patch_cpu_attn():
         v_scale: torch.Tensor,
     ) -> None:
         """Fallback implementation using PyTorch native operations when cache ops are unavailable"""
-        # slot_mapping: [num_tokens] - absolute slot indices
+        # key/value: [num_tokens, num_kv_heads, head_size]
+        # slot_mapping: [num_tokens] - absolute slot indices, negative entries are padding
         num_tokens = key.shape[0]
         num_kv_heads = key.shape[1]
         head_size = key.shape[2]
@@ -73,43 +157,40 @@ def patch_cpu_attn():
         # Get cache shapes from split_kv_cache output
         # key_cache: [num_blocks, num_kv_heads, head_size // x, block_size, x] (5D)
         # value_cache: [num_blocks, num_kv_heads, head_size, block_size] (4D)
-        num_blocks = key_cache.shape[0]
-        if len(key_cache.shape) == 5:
-            # key_cache is 5D: [num_blocks, num_kv_heads, head_size // x, block_size, x]
-            block_size = key_cache.shape[3]
-            x = key_cache.shape[4]  # Usually 16 // element_size
-        else:
-            # Fallback: assume 4D
-            block_size = key_cache.shape[-1]
-            x = 1
+        block_size = value_cache.shape[3]
         
-        # Flatten slot_mapping
+        # Drop padding tokens (negative slots), same as the native kernel which skips them
         slot_mapping_flat = slot_mapping.flatten()  # [num_tokens]
+        valid = slot_mapping_flat >= 0
+        if not bool(valid.all()):
+            key = key[valid]
+            value = value[valid]
+            slot_mapping_flat = slot_mapping_flat[valid]
+            num_tokens = slot_mapping_flat.shape[0]
+        if num_tokens == 0:
+            return
+        
+        # Quantized caches (fp8/int8) store x / scale
+        key = _PagedAttention._quantize_kv(key, k_scale, kv_cache_dtype, key_cache.dtype)
+        value = _PagedAttention._quantize_kv(value, v_scale, kv_cache_dtype, value_cache.dtype)
         
-        # Calculate block and slot indices for each token
+        # Calculate block and slot indices for all tokens at once
         block_indices = slot_mapping_flat // block_size  # [num_tokens]
         slot_indices = slot_mapping_flat % block_size    # [num_tokens]
         
-        # For each KV head, write tokens to cache
-        # key: [num_tokens, num_kv_heads, head_size]
-        # value: [num_tokens, num_kv_heads, head_size]
-        for head_idx in range(num_kv_heads):
-            for token_idx in range(num_tokens):
-                block_idx = block_indices[token_idx].item()
-                slot_idx = slot_indices[token_idx].item()
-                
-                # Handle key_cache: 5D shape [num_blocks, num_kv_heads, head_size // x, block_size, x]
-                if len(key_cache.shape) == 5:
-                    # Reshape key slice to match cache format
-                    key_slice = key[token_idx, head_idx, :]  # [head_size]
-                    key_slice_reshaped = key_slice.view(head_size // x, x)  # [head_size // x, x]
-                    key_cache[block_idx, head_idx, :, slot_idx, :] = key_slice_reshaped
-                else:
-                    # Fallback for 4D
-                    key_cache[block_idx, head_idx, :, slot_idx] = key[token_idx, head_idx, :]
-                
-                # value_cache: 4D shape [num_blocks, num_kv_heads, head_size, block_size]
-                value_cache[block_idx, head_idx, :, slot_idx] = value[token_idx, head_idx, :]
+        # Scatter all tokens and heads with one indexed write per cache.
+        # Advanced indices separated by slices put the token dimension first, so
+        # key_cache[block_indices, :, :, slot_indices, :] is [num_tokens, num_kv_heads, head_size // x, x]
+        if len(key_cache.shape) == 5:
+            x = key_cache.shape[4]  # Usually 16 // element_size
+            key_cache[block_indices, :, :, slot_indices, :] = key.reshape(
+                num_tokens, num_kv_heads, head_size // x, x)
+        else:
+            # Fallback for 4D: [num_blocks, num_kv_heads, head_size, block_size]
+            key_cache[block_indices, :, :, slot_indices] = key
+        
+        # value_cache[block_indices, :, :, slot_indices] is [num_tokens, num_kv_heads, head_size]
+        value_cache[block_indices, :, :, slot_indices] = value
     
     @staticmethod
     def write_to_paged_cache(
@@ -123,6 +204,18 @@ def patch_cpu_attn():
         v_scale: torch.Tensor,
         *args,
     ) -> None:
+        import time
+        start = time.perf_counter()
+        # _custom_ops found no native kernel at import, this is the only PyTorch
+        # reshape_and_cache (quantized caches included)
+        if getattr(ops, "reshape_and_cache_backend", "native") is None:
+            _PagedAttention._reshape_and_cache_fallback(
+                key, value, key_cache, value_cache,
+                slot_mapping.flatten(), kv_cache_dtype, k_scale, v_scale)
+            _PagedAttention._record_kernel_call(
+                "reshape_and_cache", "fallback", time.perf_counter() - start,
+                "no native reshape_and_cache registered in torch.ops")
+            return
         try:
             ops.reshape_and_cache(
                 key,
@@ -161,32 +254,24 @@ def patch_cpu_attn():
                         f"vLLM CPU cache operations are not available and fallback failed. "
                         f"Original error: {e}, import error: {e2}, fallback error: {e3}. "
                         f"Please ensure vLLM was built with CPU support or use IPEX."
-                    ) from e3'''
-    
-    # Replace
-    if old_write_to_paged_cache in content:
-        content = content.replace(old_write_to_paged_cache, new_write_to_paged_cache)
-    else:
-        print(f'Warning: Target code not found in {cpu_attn_path}')
-        # Try more flexible matching
-        import re
-        pattern = r'(@staticmethod\s+def write_to_paged_cache\([^)]+\):\s+ops\.reshape_and_cache\([^)]+\))'
-        match = re.search(pattern, content, re.DOTALL)
-        if match:
-            # More complex replacement logic
-            print('Found pattern with regex, but manual replacement needed')
-            return False
-        else:
-            return False
-    
-    # Write back to file
-    with open(cpu_attn_path, 'w') as f:
-        f.write(content)
-    
-    print(f'Successfully patched {cpu_attn_path}')
-    return True
+                    ) from e3
+                _PagedAttention._record_kernel_call(
+                    "reshape_and_cache", "fallback", time.perf_counter() - start,
+                    f"{type(e).__name__}: {e}")
+                return
+        
+        _PagedAttention._record_kernel_call(
+            "reshape_and_cache", "native", time.perf_counter() - start)'''
 
-if __name__ == '__main__':
-    success = patch_cpu_attn()
-    sys.exit(0 if success else 1)
+HUNKS = [
+    {
+        'name': 'cpu_attn.write_to_paged_cache',
+        'target': 'v1/attention/backends/cpu_attn.py',
+        'old': (OLD_WRITE_TO_PAGED_CACHE,),
+        'new': NEW_WRITE_TO_PAGED_CACHE,
+    },
+]
 
+if __name__ == '__main__':
+    import patch_vllm
+    sys.exit(patch_vllm.main(['--only', 'cpu_attn']))
@@ -1,36 +1,35 @@
 #!/usr/bin/env python3
 """
 Fix vLLM _custom_ops: add error handling and fallback for reshape_and_cache
+
+Hunk definitions only, applied by patch_vllm.py
 """
-import os
 import sys
 
-def patch_custom_ops():
-    """Add error handling for reshape_and_cache in vLLM's _custom_ops.py"""
-    # Find vllm._custom_ops file
-    custom_ops_path = None
-    for path in sys.path:
-        test_path = os.path.join(path, 'vllm', '_custom_ops.py')
-        if os.path.exists(test_path):
-            custom_ops_path = test_path
-            break
-    
-    if not custom_ops_path:
-        print('Warning: vllm._custom_ops.py not found')
-        return False
-    
-    # Read file content
-    with open(custom_ops_path, 'r') as f:
-        content = f.read()
-    
-    # Check if patch already applied (check new logic)
-    if 'cache_ops_candidates' in content and 'getattr(cache_ops, \'reshape_and_cache\', None)' in content:
-        print(f'Patch already applied to {custom_ops_path}')
-        return True
-    
-    # Find code to replace (could be original version or old patch version)
-    # First try to match old patch version
-    old_reshape_and_cache_v1 = '''def reshape_and_cache(
+# Original version
+OLD_RESHAPE_AND_CACHE_V0 = '''def reshape_and_cache(
+    key: torch.Tensor,
+    value: torch.Tensor,
+    key_cache: torch.Tensor,
+    value_cache: torch.Tensor,
+    slot_mapping: torch.Tensor,
+    kv_cache_dtype: str,
+    k_scale: torch.Tensor,
+    v_scale: torch.Tensor,
+) -> None:
+    torch.ops._C_cache_ops.reshape_and_cache(
+        key,
+        value,
+        key_cache,
+        value_cache,
+        slot_mapping,
+        kv_cache_dtype,
+        k_scale,
+        v_scale,
+    )'''
+
+# Old patch version (fixed list of namespaces, raises on failure)
+OLD_RESHAPE_AND_CACHE_V1 = '''def reshape_and_cache(
     key: torch.Tensor,
     value: torch.Tensor,
     key_cache: torch.Tensor,
@@ -78,32 +77,9 @@ def patch_custom_ops():
         "vLLM CPU cache operations are not available. "
         "Please rebuild vLLM with CPU support or use IPEX."
     ) from last_error'''
-    
-    # Original version (if old patch doesn't exist)
-    old_reshape_and_cache_v0 = '''def reshape_and_cache(
-    key: torch.Tensor,
-    value: torch.Tensor,
-    key_cache: torch.Tensor,
-    value_cache: torch.Tensor,
-    slot_mapping: torch.Tensor,
-    kv_cache_dtype: str,
-    k_scale: torch.Tensor,
-    v_scale: torch.Tensor,
-) -> None:
-    torch.ops._C_cache_ops.reshape_and_cache(
-        key,
-        value,
-        key_cache,
-        value_cache,
-        slot_mapping,
-        kv_cache_dtype,
-        k_scale,
-        v_scale,
-    )'''
-    
-    # New code (add error handling, try different namespaces)
-    # Note: don't use logger, directly raise, avoid import issues
-    new_reshape_and_cache = '''def reshape_and_cache(
+
+# Previous patch version (probes namespaces on every call)
+OLD_RESHAPE_AND_CACHE_V2 = '''def reshape_and_cache(
     key: torch.Tensor,
     value: torch.Tensor,
     key_cache: torch.Tensor,
@@ -153,36 +129,58 @@ def patch_custom_ops():
         f"This may indicate that vLLM CPU cache ops were not properly compiled. "
         f"Please ensure vLLM was built with CPU support, or use IPEX."
     ) from last_error'''
-    
-    # Replace (first try old patch version, then original version)
-    if old_reshape_and_cache_v1 in content:
-        content = content.replace(old_reshape_and_cache_v1, new_reshape_and_cache)
-        print(f'Replaced old patch version in {custom_ops_path}')
-    elif old_reshape_and_cache_v0 in content:
-        content = content.replace(old_reshape_and_cache_v0, new_reshape_and_cache)
-        print(f'Replaced original version in {custom_ops_path}')
-    else:
-        print(f'Warning: Target code not found in {custom_ops_path}')
-        print('Trying to find reshape_and_cache function...')
-        # Try using regex or more flexible matching
-        import re
-        pattern = r'def reshape_and_cache\([^)]+\):\s+.*?torch\.ops\._C_cache_ops\.reshape_and_cache'
-        if re.search(pattern, content, re.DOTALL):
-            # Found match, but need more precise replacement
-            print('Found reshape_and_cache but pattern matching failed. Manual fix needed.')
-            return False
-        else:
-            print('Could not find reshape_and_cache function to patch.')
-            return False
 
-    # Write back to file
-    with open(custom_ops_path, 'w') as f:
-        f.write(content)
+# New code (resolve the kernel once at import, bind it directly)
+# Note: use logging.getLogger instead of vllm's logger, avoid import issues
+NEW_RESHAPE_AND_CACHE = '''def _reshape_and_cache_fallback(*args, **kwargs) -> None:
+    """PyTorch fallback for reshape_and_cache when no cache ops namespace provides it"""
+    # The one implementation lives in the CPU attention backend (patch_cpu_attn), imported
+    # on first call because cpu_attn imports this module
+    from vllm.v1.attention.backends.cpu_attn import _PagedAttention
+    _PagedAttention._reshape_and_cache_fallback(*args, **kwargs)
+
+
+def _resolve_reshape_and_cache():
+    """Probe the cache ops namespaces once and return (namespace or None, callable)"""
+    import contextlib
+    import logging
+    with contextlib.suppress(ImportError):
+        import vllm._C_cache_ops  # noqa: F401
+    
+    resolve_errors = []
+    for name in ('_C_cache_ops', 'vllm_cache_ops', 'vllm_C_cache_ops'):
+        try:
+            reshape_func = getattr(getattr(torch.ops, name), 'reshape_and_cache')
+        except (AttributeError, RuntimeError) as e:
+            resolve_errors.append(f"{name}: {e}")
+            continue
+        logging.getLogger(__name__).info(
+            "reshape_and_cache bound to torch.ops.%s.reshape_and_cache", name)
+        return name, reshape_func
     
-    print(f'Successfully patched {custom_ops_path}')
-    return True
+    logging.getLogger(__name__).warning(
+        "No native reshape_and_cache found (%s), bound to the PyTorch fallback. "
+        "Please ensure vLLM was built with CPU support, or use IPEX.",
+        "; ".join(resolve_errors))
+    return None, _reshape_and_cache_fallback
 
-if __name__ == '__main__':
-    success = patch_custom_ops()
-    sys.exit(0 if success else 1)
 
+# Resolved once at import: steady-state calls go straight to the bound kernel,
+# reshape_and_cache_backend is None when it is bound to the PyTorch fallback
+reshape_and_cache_backend, reshape_and_cache = _resolve_reshape_and_cache()'''
+
+HUNKS = [
+    {
+        'name': 'custom_ops.reshape_and_cache',
+        'target': '_custom_ops.py',
+        # Upgrade from earlier patch versions first, then the original version
+        'old': (OLD_RESHAPE_AND_CACHE_V2, OLD_RESHAPE_AND_CACHE_V1, OLD_RESHAPE_AND_CACHE_V0),
+        'new': NEW_RESHAPE_AND_CACHE,
+        # The bound fallback is _PagedAttention._reshape_and_cache_fallback
+        'requires': ('cpu_attn.write_to_paged_cache',),
+    },
+]
+
+if __name__ == '__main__':
+    import patch_vllm
+    sys.exit(patch_vllm.main(['--only', 'custom_ops']))
@@ -1,35 +1,13 @@
 #!/usr/bin/env python3
 """
 Fix vLLM CPU attention: add error handling and fallback for paged_attention_v1
+
+Hunk definitions only, applied by patch_vllm.py
 """
-import os
 import sys
 
-def patch_paged_attention():
-    """Add error handling for forward_decode in vLLM's cpu_attn.py"""
-    # Find vllm.v1.attention.backends.cpu_attn file
-    cpu_attn_path = None
-    for path in sys.path:
-        test_path = os.path.join(path, 'vllm', 'v1', 'attention', 'backends', 'cpu_attn.py')
-        if os.path.exists(test_path):
-            cpu_attn_path = test_path
-            break
-    
-    if not cpu_attn_path:
-        print('Warning: vllm.v1.attention.backends.cpu_attn.py not found')
-        return False
-    
-    # Read file content
-    with open(cpu_attn_path, 'r') as f:
-        content = f.read()
-    
-    # Check if patch already applied
-    if 'def _paged_attention_v1_fallback' in content:
-        print(f'Patch already applied to {cpu_attn_path}')
-        return True
-    
-    # Find code to replace (_PagedAttention.forward_decode)
-    old_forward_decode = '''    @staticmethod
+# Code to replace (_PagedAttention.forward_decode)
+OLD_FORWARD_DECODE = '''    @staticmethod
     def forward_decode(
         output: torch.Tensor,
         query: torch.Tensor,
@@ -74,9 +52,9 @@ def patch_paged_attention():
             blocksparse_block_size,
             blocksparse_head_sliding_step,
         )'''
-    
-    # New code (add error handling and PyTorch fallback)
-    new_forward_decode = '''    @staticmethod
+
+# New code (add error handling and PyTorch fallback)
+NEW_FORWARD_DECODE = '''    @staticmethod
     def _paged_attention_v1_fallback(
         output: torch.Tensor,
         query: torch.Tensor,
@@ -94,91 +72,178 @@ def patch_paged_attention():
         block_size: int,
     ) -> None:
         """Fallback implementation using PyTorch native operations when paged_attention_v1 is unavailable"""
-        # Simplified implementation: for each sequence, gather keys/values from cache and compute attention
+        # Batched implementation: gather every sequence's blocks with one index_select,
+        # pad to max_context_len with a length mask and run attention for the whole batch
+        # query: [batch_size, num_heads, head_size]
         batch_size = query.shape[0]
         num_heads = query.shape[1]
         head_size = query.shape[2]
+        num_q_per_kv = num_heads // num_kv_heads
         
-        # Initialize output
-        output.zero_()
+        max_num_blocks = (max_context_len + block_size - 1) // block_size
+        if batch_size == 0 or max_num_blocks == 0:
+            output.zero_()
+            return
+        padded_len = max_num_blocks * block_size
         
-        for batch_idx in range(batch_size):
-            seq_len = context_lens[batch_idx].item()
-            if seq_len == 0:
-                continue
-            
-            # Get block table for this sequence
-            block_table = block_tables[batch_idx]  # [num_blocks]
-            num_blocks = (seq_len + block_size - 1) // block_size
-            
-            # Gather keys and values from cache
-            # key_cache: [num_blocks_total, num_kv_heads, head_size // x, block_size, x]
-            # value_cache: [num_blocks_total, num_kv_heads, head_size, block_size]
-            keys_list = []
-            values_list = []
-            
-            for block_idx in range(min(num_blocks, len(block_table))):
-                block_id = block_table[block_idx].item()
-                if block_id < 0:
-                    break
-                
-                # Extract keys and values from this block
-                # Handle 5D key_cache
-                if len(key_cache.shape) == 5:
-                    # key_cache: [num_blocks, num_kv_heads, head_size // x, block_size, x]
-                    x = key_cache.shape[4]
-                    key_block = key_cache[block_id]  # [num_kv_heads, head_size // x, block_size, x]
-                    key_block = key_block.view(num_kv_heads, head_size, block_size)  # Reshape to [num_kv_heads, head_size, block_size]
-                else:
-                    key_block = key_cache[block_id]  # [num_kv_heads, head_size, block_size]
-                
-                value_block = value_cache[block_id]  # [num_kv_heads, head_size, block_size]
-                
-                keys_list.append(key_block.transpose(1, 2))  # [num_kv_heads, block_size, head_size]
-                values_list.append(value_block.transpose(1, 2))  # [num_kv_heads, block_size, head_size]
-            
-            if not keys_list:
-                continue
-            
-            # Concatenate keys and values
-            keys = torch.cat(keys_list, dim=1)  # [num_kv_heads, seq_len, head_size]
-            values = torch.cat(values_list, dim=1)  # [num_kv_heads, seq_len, head_size]
-            
-            # Truncate to actual sequence length
-            keys = keys[:, :seq_len, :]  # [num_kv_heads, seq_len, head_size]
-            values = values[:, :seq_len, :]  # [num_kv_heads, seq_len, head_size]
+        # Block ids of all sequences: [batch_size, max_num_blocks]
+        # Unused entries (past the context length or negative) are clamped to block 0 and masked out below
+        block_ids = block_tables[:, :max_num_blocks].clamp(min=0)
+        flat_block_ids = block_ids.reshape(-1)
+        
+        # Gather keys and values from cache
+        # key_cache: [num_blocks_total, num_kv_heads, head_size // x, block_size, x]
+        # value_cache: [num_blocks_total, num_kv_heads, head_size, block_size]
+        if len(key_cache.shape) == 5:
+            x = key_cache.shape[4]
+            keys = key_cache.index_select(0, flat_block_ids).view(
+                batch_size, max_num_blocks, num_kv_heads, head_size // x, block_size, x)
+            # -> [batch_size, num_kv_heads, max_num_blocks, block_size, head_size // x, x]
+            keys = keys.permute(0, 2, 1, 4, 3, 5)
+        else:
+            keys = key_cache.index_select(0, flat_block_ids).view(
+                batch_size, max_num_blocks, num_kv_heads, head_size, block_size)
+            # -> [batch_size, num_kv_heads, max_num_blocks, block_size, head_size]
+            keys = keys.permute(0, 2, 1, 4, 3)
+        keys = keys.reshape(batch_size, num_kv_heads, padded_len, head_size)
+        values = value_cache.index_select(0, flat_block_ids).view(
+            batch_size, max_num_blocks, num_kv_heads, head_size, block_size)
+        values = values.permute(0, 2, 1, 4, 3).reshape(
+            batch_size, num_kv_heads, padded_len, head_size)
+        # Dequantize fp8/int8 caches (or upcast full-precision ones) to float32
+        keys = _PagedAttention._dequantize_kv(keys, k_scale, kv_cache_dtype)
+        values = _PagedAttention._dequantize_kv(values, v_scale, kv_cache_dtype)
+        
+        # GQA: group query heads by their KV head instead of copying K/V per query head
+        # q: [batch_size, num_kv_heads, num_q_per_kv, head_size]
+        q = query.view(batch_size, num_kv_heads, num_q_per_kv, head_size).float()
+        
+        # Compute attention scores: Q @ K^T -> [batch_size, num_kv_heads, num_q_per_kv, padded_len]
+        scores = torch.matmul(q, keys.transpose(-1, -2)) * scale
+        
+        positions = torch.arange(padded_len, device=query.device)
+        context_lens_2d = context_lens.view(batch_size, 1).to(positions.dtype)
+        if alibi_slopes is not None:
+            # ALiBi bias: slope * (token_position - (context_len - 1))
+            bias = (positions.view(1, -1) - context_lens_2d + 1).float()  # [batch_size, padded_len]
+            slopes = alibi_slopes.float().view(1, num_kv_heads, num_q_per_kv, 1)
+            scores = scores + slopes * bias.view(batch_size, 1, 1, padded_len)
+        
+        # Mask out positions beyond each sequence's context length
+        mask = (positions.view(1, -1) >= context_lens_2d).view(batch_size, 1, 1, padded_len)
+        scores = scores.masked_fill(mask, float('-inf'))
+        attn_weights = torch.softmax(scores, dim=-1)
+        # Sequences with context length 0 have all positions masked (softmax gives NaN), zero them
+        attn_weights = attn_weights.masked_fill(mask, 0.0)
+        
+        # Weighted sum of values -> [batch_size, num_kv_heads, num_q_per_kv, head_size]
+        attn_output = torch.matmul(attn_weights, values)
+        output.copy_(attn_output.view(batch_size, num_heads, head_size))
+    
+    @staticmethod
+    def _paged_attention_v1_streaming_fallback(
+        output: torch.Tensor,
+        query: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        block_tables: torch.Tensor,
+        context_lens: torch.Tensor,
+        max_context_len: int,
+        kv_cache_dtype: str,
+        num_kv_heads: int,
+        scale: float,
+        alibi_slopes: torch.Tensor | None,
+        k_scale: torch.Tensor,
+        v_scale: torch.Tensor,
+        block_size: int,
+    ) -> None:
+        """Flash-decoding style fallback: walk the paged blocks in place with an online softmax"""
+        # Only one block per sequence is read at a time, so peak memory is O(block_size)
+        # per sequence instead of materializing the full K/V context
+        # query: [batch_size, num_heads, head_size]
+        batch_size = query.shape[0]
+        num_heads = query.shape[1]
+        head_size = query.shape[2]
+        num_q_per_kv = num_heads // num_kv_heads
+        
+        max_num_blocks = (max_context_len + block_size - 1) // block_size
+        if batch_size == 0 or max_num_blocks == 0:
+            output.zero_()
+            return
+        
+        # GQA: KV heads are shared across their query group through broadcasting, no copies
+        # q: [batch_size, num_kv_heads, num_q_per_kv, head_size]
+        q = query.view(batch_size, num_kv_heads, num_q_per_kv, head_size).float()
+        is_5d = len(key_cache.shape) == 5
+        if is_5d:
+            x = key_cache.shape[4]
+            q_split = q.view(batch_size, num_kv_heads, num_q_per_kv, head_size // x, x)
+        if alibi_slopes is not None:
+            slopes = alibi_slopes.float().view(1, num_kv_heads, num_q_per_kv, 1)
+        
+        block_ids = block_tables[:, :max_num_blocks].clamp(min=0)
+        context_lens_2d = context_lens.view(batch_size, 1).long()
+        block_offsets = torch.arange(block_size, device=query.device)
+        
+        # Running max, softmax denominator and weighted value sum per query head
+        running_max = torch.full(
+            (batch_size, num_kv_heads, num_q_per_kv, 1), float('-inf'),
+            dtype=torch.float32, device=query.device)
+        running_sum = torch.zeros_like(running_max)
+        acc = torch.zeros(
+            (batch_size, num_kv_heads, num_q_per_kv, head_size),
+            dtype=torch.float32, device=query.device)
+        
+        for block_idx in range(max_num_blocks):
+            ids = block_ids[:, block_idx]
+            # Blocks are dequantized (fp8/int8) or upcast to float32 one at a time
+            # value_block: [batch_size, num_kv_heads, head_size, block_size]
+            value_block = _PagedAttention._dequantize_kv(
+                value_cache.index_select(0, ids), v_scale, kv_cache_dtype)
+            key_block = _PagedAttention._dequantize_kv(
+                key_cache.index_select(0, ids), k_scale, kv_cache_dtype)
+            if is_5d:
+                # key_block: [batch_size, num_kv_heads, head_size // x, block_size, x]
+                scores = torch.einsum('bhgcx,bhctx->bhgt', q_split, key_block)
+            else:
+                # key_block: [batch_size, num_kv_heads, head_size, block_size]
+                scores = torch.matmul(q, key_block)
+            scores = scores * scale  # [batch_size, num_kv_heads, num_q_per_kv, block_size]
             
-            # Get query for this batch
-            q = query[batch_idx]  # [num_heads, head_size]
+            positions = block_idx * block_size + block_offsets  # [block_size]
+            if alibi_slopes is not None:
+                # ALiBi bias: slope * (token_position - (context_len - 1))
+                bias = (positions.view(1, -1) - context_lens_2d + 1).float()
+                scores = scores + slopes * bias.view(batch_size, 1, 1, block_size)
+            mask = (positions.view(1, -1) >= context_lens_2d).view(batch_size, 1, 1, block_size)
+            scores = scores.masked_fill(mask, float('-inf'))
             
-            # Compute attention scores: Q @ K^T
-            # q: [num_heads, head_size], keys: [num_kv_heads, seq_len, head_size]
-            # We need to handle GQA (grouped query attention) where num_heads != num_kv_heads
-            if num_heads == num_kv_heads:
-                # Standard multi-head attention
-                # q: [num_heads, head_size], keys: [num_kv_heads, seq_len, head_size]
-                # For each head, compute q @ k^T
-                # q: [num_heads, 1, head_size], keys: [num_kv_heads, head_size, seq_len]
-                q_expanded = q.unsqueeze(1)  # [num_heads, 1, head_size]
-                keys_t = keys.transpose(1, 2)  # [num_kv_heads, head_size, seq_len]
-                scores = torch.bmm(q_expanded, keys_t)  # [num_heads, 1, seq_len]
-                scores = scores * scale
-                attn_weights = torch.softmax(scores, dim=-1)  # [num_heads, 1, seq_len]
-                attn_output = torch.bmm(attn_weights, values)  # [num_heads, 1, head_size]
-                output[batch_idx] = attn_output.squeeze(1)  # [num_heads, head_size]
-            else:
-                # GQA: repeat keys/values for each query head
-                num_q_per_kv = num_heads // num_kv_heads
-                keys_expanded = keys.repeat_interleave(num_q_per_kv, dim=0)  # [num_heads, seq_len, head_size]
-                values_expanded = values.repeat_interleave(num_q_per_kv, dim=0)  # [num_heads, seq_len, head_size]
-                
-                q_expanded = q.unsqueeze(1)  # [num_heads, 1, head_size]
-                keys_t = keys_expanded.transpose(1, 2)  # [num_heads, head_size, seq_len]
-                scores = torch.bmm(q_expanded, keys_t)  # [num_heads, 1, seq_len]
-                scores = scores * scale
-                attn_weights = torch.softmax(scores, dim=-1)  # [num_heads, 1, seq_len]
-                attn_output = torch.bmm(attn_weights, values_expanded)  # [num_heads, 1, head_size]
-                output[batch_idx] = attn_output.squeeze(1)  # [num_heads, head_size]
+            # Online softmax update; rows that have seen no valid position yet keep max=-inf,
+            # use 0 as the reference for them so exp() stays finite
+            new_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+            safe_max = new_max.masked_fill(torch.isinf(new_max), 0.0)
+            correction = torch.exp(running_max - safe_max)
+            probs = torch.exp(scores - safe_max)
+            running_sum = running_sum * correction + probs.sum(dim=-1, keepdim=True)
+            acc = acc * correction + torch.matmul(probs, value_block.transpose(-1, -2))
+            running_max = new_max
+        
+        # Sequences with context length 0 have acc == 0 and running_sum == 0, output zeros
+        attn_output = acc / running_sum.clamp(min=torch.finfo(torch.float32).tiny)
+        output.copy_(attn_output.view(batch_size, num_heads, head_size))
+    
+    _decode_fallback_mode: str | None = None
+    
+    @staticmethod
+    def _get_decode_fallback_mode() -> str:
+        """Decode fallback mode from VLLM_CPU_DECODE_FALLBACK: batched (default) or streaming"""
+        if _PagedAttention._decode_fallback_mode is None:
+            import os
+            mode = os.environ.get("VLLM_CPU_DECODE_FALLBACK", "batched").strip().lower()
+            if mode not in ("batched", "streaming"):
+                mode = "batched"
+            _PagedAttention._decode_fallback_mode = mode
+        return _PagedAttention._decode_fallback_mode
     
     @staticmethod
     def forward_decode(
@@ -204,6 +269,8 @@ def patch_paged_attention():
         blocksparse_head_sliding_step: int = 0
         block_size = value_cache.shape[3]
         
+        import time
+        start = time.perf_counter()
         try:
             ops.paged_attention_v1(
                 output,
@@ -228,8 +295,13 @@ def patch_paged_attention():
             )
         except (AttributeError, RuntimeError) as e:
             # Use PyTorch fallback implementation
+            decode_mode = _PagedAttention._get_decode_fallback_mode()
+            if decode_mode == "streaming":
+                fallback = _PagedAttention._paged_attention_v1_streaming_fallback
+            else:
+                fallback = _PagedAttention._paged_attention_v1_fallback
             try:
-                _PagedAttention._paged_attention_v1_fallback(
+                fallback(
                     output, query, key_cache, value_cache,
                     block_tables, context_lens, max_context_len,
                     kv_cache_dtype, num_kv_heads, scale, alibi_slopes,
@@ -240,31 +312,26 @@ def patch_paged_attention():
                     f"vLLM CPU paged_attention_v1 operations are not available and fallback failed. "
                     f"Original error: {e}, fallback error: {e2}. "
                     f"Please ensure vLLM was built with CPU support or use IPEX."
-                ) from e2'''
-    
-    # Replace
-    if old_forward_decode in content:
-        content = content.replace(old_forward_decode, new_forward_decode)
-    else:
-        print(f'Warning: Target code not found in {cpu_attn_path}')
-        # Try more flexible matching
-        import re
-        pattern = r'(@staticmethod\s+def forward_decode\([^)]+\):\s+block_size = value_cache\.shape\[3\]\s+ops\.paged_attention_v1\([^)]+\))'
-        match = re.search(pattern, content, re.DOTALL)
-        if match:
-            print('Found pattern with regex, but manual replacement needed')
-            return False
-        else:
-            return False
-    
-    # Write back to file
-    with open(cpu_attn_path, 'w') as f:
-        f.write(content)
-    
-    print(f'Successfully patched {cpu_attn_path}')
-    return True
+                ) from e2
+            _PagedAttention._record_kernel_call(
+                "paged_attention_v1", "fallback", time.perf_counter() - start,
+                f"{type(e).__name__}: {e}")
+            return
+        
+        _PagedAttention._record_kernel_call(
+            "paged_attention_v1", "native", time.perf_counter() - start)'''
 
-if __name__ == '__main__':
-    success = patch_paged_attention()
-    sys.exit(0 if success else 1)
+HUNKS = [
+    {
+        'name': 'cpu_attn.forward_decode',
+        'target': 'v1/attention/backends/cpu_attn.py',
+        'old': (OLD_FORWARD_DECODE,),
+        'new': NEW_FORWARD_DECODE,
+        # Kernel counters and KV dequantization helpers come from patch_cpu_attn.py
+        'requires': ('cpu_attn.write_to_paged_cache',),
+    },
+]
 
+if __name__ == '__main__':
+    import patch_vllm
+    sys.exit(patch_vllm.main(['--only', 'paged_attention']))
@@ -1,35 +1,26 @@
 #!/usr/bin/env python3
 """
-Fix vLLM CPU warmup: skip warmup phase to reduce memory usage
-"""
-import os
-import sys
+Fix vLLM CPU warmup: run a memory-bounded, shape-bucketed warmup at startup
+
+The stock warmup runs a single large dummy batch at init, which OOMs on small hosts,
+and skipping it moves the whole warmup cost onto the first real requests. Instead,
+dummy batches of increasing size run on the worker thread before the server reports
+ready, stopping before the memory growth exceeds a budget, so the first request lands
+on a warm model and no dummy run ever sits on a request's path.
 
-def patch_skip_warmup():
-    """Skip warmup in vLLM's cpu_model_runner.py"""
-    # Find vllm.v1.worker.cpu_model_runner.py file
-    cpu_model_runner_path = None
-    for path in sys.path:
-        test_path = os.path.join(path, 'vllm', 'v1', 'worker', 'cpu_model_runner.py')
-        if os.path.exists(test_path):
-            cpu_model_runner_path = test_path
-            break
+Environment:
+    VLLM_CPU_WARMUP_MODE: full (default, memory-bounded warmup of all buckets) or skip
+                          (no warmup)
+    VLLM_CPU_WARMUP_MEMORY_MB: memory growth budget for the warmup (default 1024)
+    VLLM_CPU_WARMUP_BUCKETS: comma-separated token counts (default: powers of two up to
+                             the stock warmup size)
 
-    if not cpu_model_runner_path:
-        print('Warning: vllm.v1.worker.cpu_model_runner.py not found')
-        return False
+Hunk definitions only, applied by patch_vllm.py
+"""
+import sys
 
-    # Read file content
-    with open(cpu_model_runner_path, 'r') as f:
-        content = f.read()
-    
-    # Check if patch already applied
-    if 'def warming_up_model(self) -> None:' in content and 'logger.info("Skipping warmup to reduce memory usage...")' in content:
-        print(f'Patch already applied to {cpu_model_runner_path}')
-        return True
-    
-    # Find code to replace
-    old_warming_up = '''    def warming_up_model(self) -> None:
+# Code to replace
+OLD_WARMING_UP = '''    def warming_up_model(self) -> None:
         logger.info("Warming up model for the compilation...")
         # Only generate graph for the generic shape
         with _set_global_compilation_settings(self.vllm_config):
@@ -42,8 +33,8 @@ def patch_skip_warmup():
 
         logger.info("Warming up done.")'''
 
-    # New code (skip warmup)
-    new_warming_up = '''    def warming_up_model(self) -> None:
+# Previous version of this patch (skip warmup), replaced on upgrade
+OLD_SKIP_WARMUP = '''    def warming_up_model(self) -> None:
         logger.info("Skipping warmup to reduce memory usage...")
         # Skip warmup to avoid OOM during initialization
         # The model will be warmed up on first request instead
@@ -57,21 +48,99 @@ def patch_skip_warmup():
 
         logger.info("Warmup skipped.")'''
 
-    # Replace
-    if old_warming_up in content:
-        content = content.replace(old_warming_up, new_warming_up)
-    else:
-        print(f'Warning: Target code not found in {cpu_model_runner_path}')
-        return False
+# New code (memory-bounded, shape-bucketed warmup before the server reports ready)
+NEW_WARMING_UP = '''    def warming_up_model(self) -> None:
+        import os
+        mode = os.getenv("VLLM_CPU_WARMUP_MODE", "full").lower()
+        if mode == "skip":
+            logger.info("Warmup skipped (VLLM_CPU_WARMUP_MODE=skip).")
+            return
+        if mode != "full":
+            logger.warning("Unknown VLLM_CPU_WARMUP_MODE=%r, using full", mode)
+        buckets = self._warmup_buckets()
+        logger.info("Warming up model for the compilation, buckets: %s", buckets)
+        try:
+            state = self._warmup_start(len(buckets))
+        except Exception as e:
+            logger.warning("Warmup skipped, memory usage unavailable: %s", e)
+            return
+        for num_tokens in buckets:
+            if not self._warmup_bucket(state, num_tokens):
+                break
+        logger.info("Warming up done, warmed buckets: %s", state["warmed"])
 
-    # Write back to file
-    with open(cpu_model_runner_path, 'w') as f:
-        f.write(content)
+    def _warmup_buckets(self) -> list:
+        """Token counts to warm up, ascending so the memory budget stops the largest ones"""
+        import os
+        max_tokens = min(
+            max(16, self.max_num_reqs),
+            self.scheduler_config.max_num_batched_tokens,
+        )
+        env_buckets = os.getenv("VLLM_CPU_WARMUP_BUCKETS", "")
+        if env_buckets:
+            buckets = {int(b) for b in env_buckets.split(",") if b.strip()}
+            return sorted(b for b in buckets if 0 < b <= self.scheduler_config.max_num_batched_tokens)
+        buckets = []
+        num_tokens = 1
+        while num_tokens < max_tokens:
+            buckets.append(num_tokens)
+            num_tokens *= 2
+        buckets.append(max_tokens)
+        return buckets
 
-    print(f'Successfully patched {cpu_model_runner_path}')
-    return True
+    def _warmup_start(self, total: int) -> dict:
+        import os
+        import psutil
+        process = psutil.Process()
+        return {
+            "process": process,
+            "start_rss": process.memory_info().rss,
+            "budget": float(os.getenv("VLLM_CPU_WARMUP_MEMORY_MB", "1024")) * 1024 * 1024,
+            "last_growth": 0,
+            "warmed": [],
+            "total": total,
+        }
 
-if __name__ == '__main__':
-    success = patch_skip_warmup()
-    sys.exit(0 if success else 1)
+    def _warmup_bucket(self, state: dict, num_tokens: int) -> bool:
+        """Run one warmup bucket, False if it would exceed the memory budget"""
+        import time
+        import psutil
+        process = state["process"]
+        warmed = state["warmed"]
+        idx = len(warmed) + 1
+        used = process.memory_info().rss - state["start_rss"]
+        # Scale the previous bucket's growth, allocations of earlier buckets are reused
+        projected = state["last_growth"] * num_tokens / warmed[-1] if warmed else 0
+        available = psutil.virtual_memory().available
+        if used + projected > state["budget"] or projected > available:
+            logger.warning(
+                "Warmup stopped before bucket %d/%d (%d tokens): projected %.0f MiB "
+                "would exceed the %.0f MiB budget (used %.0f MiB, available %.0f MiB)",
+                idx, state["total"], num_tokens, projected / 2**20, state["budget"] / 2**20,
+                used / 2**20, available / 2**20)
+            return False
+        bucket_start = time.perf_counter()
+        rss_before = process.memory_info().rss
+        with _set_global_compilation_settings(self.vllm_config):
+            self._dummy_run(num_tokens)
+        growth = max(process.memory_info().rss - rss_before, 0)
+        state["last_growth"] = growth
+        warmed.append(num_tokens)
+        logger.info(
+            "Warmup bucket %d/%d (%d tokens) done in %.2fs, memory +%.0f MiB",
+            idx, state["total"], num_tokens, time.perf_counter() - bucket_start,
+            growth / 2**20)
+        return True'''
 
+HUNKS = [
+    {
+        'name': 'cpu_model_runner.warming_up_model',
+        'target': 'v1/worker/cpu_model_runner.py',
+        'old': (OLD_WARMING_UP, OLD_SKIP_WARMUP),
+        'new': NEW_WARMING_UP,
+    },
+]
+
+if __name__ == '__main__':
+    import patch_vllm
+    sys.exit(patch_vllm.main(['--only', 'skip_warmup']))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Apply all vLLM patches in a single pass
+
+Locates the vLLM install once, checks every hunk against the installed files before
+writing anything, applies them, records a manifest of content hashes and byte-compiles
+the patched modules so the container never recompiles stale .pyc. The hunks match on
+code text, not on version numbers: a vLLM release that changed the patched code fails
+the check instead of being patched blindly.
+
+Hunks are defined in the patch_*.py modules (HUNKS lists):
+    name:     unique hunk name
+    target:   file path relative to the vllm package directory
+    old:      code variants to replace, tried in order
+    new:      replacement code, its presence means the hunk is already applied
+    requires: (optional) names of hunks that must be applied before this one
+
+Usage:
+    python3 patch_vllm.py                               # apply all patches
+    python3 patch_vllm.py --check                       # report status, don't write
+    python3 patch_vllm.py --only cpu_attn paged_attention
+"""
+import argparse
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import os
+import py_compile
+import sys
+
+import patch_cpu_attn
+import patch_cpu_platform
+import patch_custom_ops
+import patch_import_cache_ops
+import patch_paged_attention
+import patch_skip_warmup
+
+# Application order: hunks that others depend on come first
+PATCH_MODULES = {
+    'cpu_platform': patch_cpu_platform,
+    'import_cache_ops': patch_import_cache_ops,
+    'custom_ops': patch_custom_ops,
+    'cpu_attn': patch_cpu_attn,
+    'paged_attention': patch_paged_attention,
+    'skip_warmup': patch_skip_warmup,
+}
+
+MANIFEST_NAME = '.vllm_demo_patches.json'
+
+def find_vllm_root():
+    """Locate the vllm package directory without importing vllm"""
+    spec = importlib.util.find_spec('vllm')
+    if spec is not None and spec.submodule_search_locations:
+        return list(spec.submodule_search_locations)[0]
+    return None
+
+def get_vllm_version():
+    """Installed vLLM distribution version, None if it has no metadata"""
+    try:
+        return importlib.metadata.version('vllm')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def hunk_hash(hunk):
+    """Hash of a hunk definition, changes whenever its patch code changes"""
+    return sha256_text(json.dumps([hunk['name'], hunk['target'], list(hunk['old']), hunk['new']]))
+
+def select_hunks(only=None):
+    """Hunks of the selected patch modules (all by default), in application order"""
+    unknown = set(only or ()) - set(PATCH_MODULES)
+    if unknown:
+        raise ValueError(f'Unknown patch(es): {", ".join(sorted(unknown))}. '
+                         f'Available: {", ".join(PATCH_MODULES)}')
+    hunks = []
+    for name, module in PATCH_MODULES.items():
+        if only and name not in only:
+            continue
+        hunks.extend(module.HUNKS)
+    return hunks
+
+def all_hunks_by_name():
+    return {h['name']: h for module in PATCH_MODULES.values() for h in module.HUNKS}
+
+def plan_patches(vllm_root, vllm_version, hunks):
+    """Read every target once and apply the hunks in memory
+
+    Returns (files, statuses, errors): files maps relative path -> (original, patched)
+    content, statuses lists (hunk name, status), errors lists everything that would
+    prevent a complete application. Nothing is written here.
+    """
+    known_hunks = all_hunks_by_name()
+    selected = {h['name'] for h in hunks}
+    contents = {}
+    originals = {}
+    statuses = []
+    errors = []
+
+    for hunk in hunks:
+        name = hunk['name']
+        target = hunk['target']
+        if target not in contents:
+            path = os.path.join(vllm_root, *target.split('/'))
+            if not os.path.exists(path):
+                errors.append(f'{name}: target file {path} not found')
+                continue
+            with open(path, 'r') as f:
+                contents[target] = originals[target] = f.read()
+        content = contents[target]
+
+        for required in hunk.get('requires', ()):
+            required_hunk = known_hunks[required]
+            if required in selected:
+                continue
+            required_content = contents.get(required_hunk['target'])
+            if required_content is None:
+                required_path = os.path.join(vllm_root, *required_hunk['target'].split('/'))
+                if os.path.exists(required_path):
+                    with open(required_path, 'r') as f:
+                        required_content = f.read()
+            if required_content is None or required_hunk['new'] not in required_content:
+                errors.append(f'{name}: requires {required}, which is neither applied nor selected')
+
+        if hunk['new'] in content:
+            statuses.append((name, 'already applied'))
+            continue
+        for variant_idx, old in enumerate(hunk['old']):
+            if old in content:
+                contents[target] = content.replace(old, hunk['new'])
+                statuses.append((name, f'applied (replaced variant {variant_idx})'))
+                break
+        else:
+            errors.append(f'{name}: target code not found in {target} '
+                          f'(vLLM {vllm_version} may be incompatible with this patch)')
+
+    files = {
+        target: (originals[target], contents[target])
+        for target in contents
+    }
+    for target, (original, patched) in files.items():
+        if original == patched:
+            continue
+        try:
+            compile(patched, target, 'exec')
+        except SyntaxError as e:
+            errors.append(f'{target}: patched file does not compile ({e})')
+    return files, statuses, errors
+
+def load_manifest(vllm_root):
+    path = os.path.join(vllm_root, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def manifest_up_to_date(vllm_root, manifest, vllm_version, hunks):
+    """True if the manifest records these hunks for this version and no file changed since"""
+    if manifest is None or manifest.get('vllm_version') != vllm_version:
+        return False
+    applied = manifest.get('hunks')
+    if not isinstance(applied, dict) or any(applied.get(h['name']) != hunk_hash(h) for h in hunks):
+        return False
+    for target, hashes in manifest.get('files', {}).items():
+        path = os.path.join(vllm_root, *target.split('/'))
+        try:
+            with open(path, 'r') as f:
+                if sha256_text(f.read()) != hashes['patched_sha256']:
+                    return False
+        except OSError:
+            return False
+    return True
+
+def write_file_atomic(path, content):
+    tmp_path = f'{path}.patch-tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def byte_compile(paths):
+    """Refresh the .pyc of patched modules so imports don't recompile them at startup"""
+    for path in paths:
+        py_compile.compile(path, doraise=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply all vLLM patches in a single pass')
+    parser.add_argument('--only', nargs='+', metavar='PATCH',
+                        help=f'Apply only these patches ({", ".join(PATCH_MODULES)})')
+    parser.add_argument('--check', action='store_true',
+                        help='Report what would be applied without writing, exit 1 if anything is pending')
+    parser.add_argument('--vllm-root', default=None, help='vllm package directory (default: auto-detect)')
+    args = parser.parse_args(argv)
+
+    vllm_root = args.vllm_root or find_vllm_root()
+    if not vllm_root or not os.path.isdir(vllm_root):
+        print('Error: vllm package not found')
+        return 1
+    vllm_version = get_vllm_version()
+    print(f'vLLM {vllm_version} at {vllm_root}')
+
+    try:
+        hunks = select_hunks(args.only)
+    except ValueError as e:
+        print(f'Error: {e}')
+        return 1
+
+    manifest = load_manifest(vllm_root)
+    if manifest_up_to_date(vllm_root, manifest, vllm_version, hunks):
+        print(f'All {len(hunks)} patches already applied (manifest up to date)')
+        return 0
+
+    files, statuses, errors = plan_patches(vllm_root, vllm_version, hunks)
+    for name, status in statuses:
+        print(f'  {name}: {status}')
+    if errors:
+        # Nothing has been written yet, the install is left untouched
+        print(f'Error: {len(errors)} patch(es) cannot be applied, no files were modified:')
+        for error in errors:
+            print(f'  {error}')
+        return 1
+
+    changed = [target for target, (original, patched) in files.items() if original != patched]
+    if args.check:
+        if changed:
+            print(f'Pending changes in: {", ".join(changed)}')
+            return 1
+        print('All patches already applied')
+        return 0
+
+    for target in changed:
+        write_file_atomic(os.path.join(vllm_root, *target.split('/')), files[target][1])
+        print(f'Successfully patched {target}')
+    byte_compile([os.path.join(vllm_root, *target.split('/')) for target in files])
+
+    # Merge into the existing manifest, so an --only run keeps the other patches' records
+    previous = manifest if manifest and manifest.get('vllm_version') == vllm_version else {}
+    applied = previous.get('hunks') if isinstance(previous.get('hunks'), dict) else {}
+    applied.update({h['name']: hunk_hash(h) for h in hunks})
+    recorded_files = dict(previous.get('files', {}))
+    for target, (original, patched) in files.items():
+        # Keep the pristine hash of a file an earlier run already patched
+        original_sha256 = recorded_files.get(target, {}).get('original_sha256', sha256_text(original))
+        recorded_files[target] = {
+            'original_sha256': original_sha256,
+            'patched_sha256': sha256_text(patched),
+        }
+    manifest = {
+        'vllm_version': vllm_version,
+        'hunks': applied,
+        'files': recorded_files,
+    }
+    write_file_atomic(os.path.join(vllm_root, MANIFEST_NAME), json.dumps(manifest, indent=2) + '\n')
+    print(f'Applied {len(changed)} file(s), manifest written to {MANIFEST_NAME}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
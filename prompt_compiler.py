@@ -0,0 +1,201 @@
+"""
+Prompt compiler - builds the agent's system prompt from one canonical tool spec
+
+Every piece of tool guidance lives once in TOOL_SPECS: the StructuredTool descriptions
+(rendered into {tools} by create_react_agent) and the examples are generated from it, and
+the usage rules are stated once for all tools. Sections are counted with the model's
+tokenizer (vLLM /tokenize) and optional sections are dropped when the prompt exceeds the
+token budget.
+
+Modes:
+    react: tool descriptions and the ReAct format are part of the system prompt
+    tools: native tool calling, the tools are sent as OpenAI tool schemas that vLLM
+           renders into the prompt itself, so the system prompt has no tool scaffolding
+"""
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from langchain_core.tools.render import render_text_description
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+logger = logging.getLogger(__name__)
+
+# Canonical tool spec: the only place tool guidance is written
+TOOL_SPECS = [
+    {
+        "name": "add_numbers",
+        "description": "Add two numbers, returns a + b.",
+        "example": ("Calculate 5 + 3", "add_numbers(5, 3)", "8", "The answer is 8"),
+    },
+    {
+        "name": "multiply_numbers",
+        "description": "Multiply two numbers, returns a * b.",
+        "example": ("4 * 7", "multiply_numbers(4, 7)", "28", "The answer is 28"),
+    },
+    {
+        "name": "calculate_expression",
+        "description": "Evaluate an expression of numbers, + - * / and parentheses, e.g. '2+3*4'.",
+        "example": ("计算 2+3*4", 'calculate_expression("2+3*4")', "14", "答案是 14"),
+    },
+]
+
+ROLE_SECTION = "You are a friendly math calculation assistant."
+
+RULES_SECTION = """RULES (they prevent infinite tool calls):
+1. Greetings, casual chat and non-math questions: reply directly, never call a tool.
+2. Only call a tool when the user explicitly asks for a calculation ("calculate", "what is X + Y", "计算", ...). If the intent is unclear, ask for clarification.
+3. Call at most ONE tool per request. After its result, immediately give the final answer as "The answer is [result]" or "答案是 [result]" and stop."""
+
+TOOLS_SECTION = """You have access to the following tools:
+
+{tools}"""
+
+FORMAT_SECTION = """Use the following format:
+
+Question: the input question you need to answer
+Thought: you should think about what to do
+Action: the action to take, should be one of [{tool_names}]
+Action Input: the input to the action
+Observation: the result of the action
+... (this Thought/Action/Action Input/Observation can repeat N times)
+Thought: I now know the final answer
+Final Answer: the final answer to the original input question
+
+Begin!"""
+
+# Tool schemas sent with each request in tools mode, counted but not part of the template
+TOOL_SCHEMAS_SECTION = "{tool_schemas}"
+
+PROMPT_MODES = ("react", "tools")
+
+def tool_description(name: str) -> str:
+    """StructuredTool description for a tool, from the canonical spec"""
+    for spec in TOOL_SPECS:
+        if spec["name"] == name:
+            return spec["description"]
+    raise KeyError(f"No tool spec for {name}")
+
+def examples_section(tool_specs: List[Dict[str, Any]]) -> str:
+    lines = ['Examples:', '- "你好" or "hello" -> reply "你好！我是数学计算助手..." without tools']
+    for spec in tool_specs:
+        question, call, result, answer = spec["example"]
+        lines.append(f'- "{question}" -> {call} once, result {result}, reply "{answer}", END')
+    return "\n".join(lines)
+
+def build_sections(tool_specs: List[Dict[str, Any]] = TOOL_SPECS, mode: str = "react") -> List[Dict[str, Any]]:
+    """
+    Prompt sections in prompt order.
+
+    Optional sections carry a drop_priority; under budget pressure the lowest priority is
+    dropped first. Section order never changes, so the rendered prefix stays byte-stable.
+    Sections with in_template False cost prompt tokens but are sent outside the template.
+    """
+    if mode not in PROMPT_MODES:
+        raise ValueError(f"Unknown prompt mode {mode!r}, expected one of {PROMPT_MODES}")
+    examples = {"name": "examples", "text": examples_section(tool_specs), "required": False, "drop_priority": 0}
+    if mode == "tools":
+        return [
+            {"name": "role", "text": ROLE_SECTION, "required": True},
+            {"name": "rules", "text": RULES_SECTION, "required": True},
+            examples,
+            {"name": "tools", "text": TOOL_SCHEMAS_SECTION, "required": True, "in_template": False},
+        ]
+    return [
+        {"name": "role", "text": ROLE_SECTION, "required": True},
+        {"name": "rules", "text": RULES_SECTION, "required": True},
+        {"name": "tools", "text": TOOLS_SECTION, "required": True},
+        examples,
+        {"name": "format", "text": FORMAT_SECTION, "required": True},
+    ]
+
+async def count_tokens(texts: List[str], tokenize_url: str, model: str,
+                       client: Optional[httpx.AsyncClient] = None) -> Optional[List[int]]:
+    """Count tokens with the model's tokenizer via vLLM /tokenize, None if the server is unavailable"""
+    owns_client = client is None
+    client = client or httpx.AsyncClient(timeout=10.0)
+    try:
+        counts = []
+        for text in texts:
+            response = await client.post(
+                tokenize_url,
+                json={"model": model, "prompt": text, "add_special_tokens": False}
+            )
+            response.raise_for_status()
+            counts.append(response.json()["count"])
+        return counts
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        logger.warning(f"Token counting via {tokenize_url} failed ({type(e).__name__}: {e}), using estimates")
+        return None
+    finally:
+        if owns_client:
+            await client.aclose()
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 UTF-8 bytes per token) when the tokenizer is unavailable"""
+    return max(1, len(text.encode("utf-8")) // 4)
+
+async def compile_prompt(tools: List[Any], budget: int, count: Callable, mode: str = "react",
+                         tool_specs: List[Dict[str, Any]] = TOOL_SPECS) -> Dict[str, Any]:
+    """
+    Assemble the system prompt template within a token budget.
+
+    count is an async callable taking a list of texts and returning their token counts
+    (or None to fall back to estimates). Returns {"template", "rendered", "report"}: template
+    keeps the {tools} / {tool_names} placeholders for create_react_agent, rendered is the
+    static prompt text as sent (tool schemas included), report has the per-section token
+    costs. Raises ValueError if the required sections alone exceed the budget.
+    """
+    sections = build_sections(tool_specs, mode)
+    # Render placeholders exactly as the agent will, so the counts match what vLLM sees
+    rendered_values = {
+        "{tools}": render_text_description(tools),
+        "{tool_names}": ", ".join(t.name for t in tools),
+        "{tool_schemas}": json.dumps([convert_to_openai_tool(t) for t in tools], ensure_ascii=False),
+    }
+
+    def render(text):
+        for placeholder, value in rendered_values.items():
+            text = text.replace(placeholder, value)
+        return text
+
+    texts = [render(section["text"]) for section in sections]
+    counts = await count(texts + ["\n\n".join(texts)])
+    estimated = counts is None
+    if estimated:
+        counts = [estimate_tokens(text) for text in texts + ["\n\n".join(texts)]]
+    for section, tokens in zip(sections, counts):
+        section["tokens"] = tokens
+
+    kept = list(sections)
+    dropped = []
+    total = counts[-1]
+    # Section counts are summed for the decision, the full prompt is counted once at the end
+    optional = sorted((s for s in sections if not s["required"]), key=lambda s: s["drop_priority"])
+    while budget and sum(s["tokens"] for s in kept) > budget and optional:
+        section = optional.pop(0)
+        kept.remove(section)
+        dropped.append(section["name"])
+    if dropped:
+        kept_texts = [render(section["text"]) for section in kept]
+        recount = await count(["\n\n".join(kept_texts)]) if not estimated else None
+        total = recount[0] if recount else estimate_tokens("\n\n".join(kept_texts))
+        logger.warning(f"Prompt over the {budget} token budget, dropped sections: {dropped}")
+    if budget and total > budget:
+        raise ValueError(f"Prompt needs {total} tokens, over the budget of {budget} "
+                         f"(required sections: {[s['name'] for s in kept]})")
+
+    report = {
+        "mode": mode,
+        "budget": budget,
+        "total_tokens": total,
+        "estimated": estimated,
+        "sections": {section["name"]: section["tokens"] for section in sections},
+        "dropped": dropped,
+    }
+    return {
+        "template": "\n\n".join(section["text"] for section in kept if section.get("in_template", True)),
+        "rendered": "\n\n".join(render(section["text"]) for section in kept),
+        "report": report,
+    }
@@ -40,7 +40,11 @@ python -m vllm.entrypoints.openai.api_server \
     --model "$VLLM_MODEL_NAME" \
     --port 8001 \
     --host 0.0.0.0 \
-    --trust-remote-code &
+    --trust-remote-code \
+    --enable-prefix-caching \
+    --enable-prompt-tokens-details \
+    --enable-auto-tool-choice \
+    --tool-call-parser hermes &
 VLLM_PID=$!
 echo "vLLM server PID: $VLLM_PID"
 
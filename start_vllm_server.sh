@@ -39,6 +39,11 @@ echo "Model: $MODEL_PATH"
 echo "Host: $HOST"
 echo "Port: $PORT"
 
+# KV cache element type: auto (model dtype) or fp8 / fp8_e5m2 to halve KV cache memory
+# (the patched PyTorch fallback kernels quantize/dequantize with k_scale/v_scale)
+KV_CACHE_DTYPE="${VLLM_KV_CACHE_DTYPE:-auto}"
+echo "KV cache dtype: $KV_CACHE_DTYPE"
+
 # Set HuggingFace offline mode, force using local files, avoid network download
 export HF_HUB_OFFLINE=1
 export TRANSFORMERS_OFFLINE=1
@@ -47,6 +52,10 @@ export TRANSFORMERS_OFFLINE=1
 # Reduce max_model_len to fit KV cache memory limits
 # Disable custom operations to avoid missing custom ops issues in CPU version
 # Set custom_ops=none via --compilation-config
+# Automatic prefix caching: the chat server's static system prompt (instructions + tools) is
+# prefilled once and reused; prompt tokens details report cached tokens in each response's usage
+# Auto tool choice with the hermes parser (Qwen2.5's tool call format) returns structured
+# tool_calls for the chat server's CHAT_AGENT_MODE=tools
 exec python -m vllm.entrypoints.openai.api_server \
     --model "$MODEL_PATH" \
     --port "$PORT" \
@@ -56,6 +65,11 @@ exec python -m vllm.entrypoints.openai.api_server \
     --max-model-len 2048 \
     --max-num-batched-tokens 2048 \
     --max-num-seqs 16 \
+    --kv-cache-dtype "$KV_CACHE_DTYPE" \
+    --enable-prefix-caching \
+    --enable-prompt-tokens-details \
+    --enable-auto-tool-choice \
+    --tool-call-parser hermes \
     --disable-custom-all-reduce \
     --enforce-eager \
     --compilation-config '{"custom_ops": ["none"]}'